@@ -1,3 +1,5 @@
-from .metrics import dice_metrics
+from .accumulator import DiceAccumulator
+from .metrics import dice_metrics, merge_partials
+from .watch import watch_predictions
 
-__all__ = ['dice_metrics']
+__all__ = ['DiceAccumulator', 'dice_metrics', 'merge_partials', 'watch_predictions']
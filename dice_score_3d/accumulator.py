@@ -0,0 +1,132 @@
+from typing import Iterable, Tuple, Union
+
+import numpy as np
+from numpy import ndarray
+
+from dice_score_3d.metrics import ENGINES, average, dice_from_counts, multi_class_dice
+
+
+class DiceAccumulator:
+    """ Accumulates Dice metrics from in-memory pairs of GT and prediction, one case at a time. Only the per-label voxel
+    counts and score sums are kept, so the memory does not grow with the number of cases, unless `keep_cases` is used.
+    Accumulators can be merged, e.g. when each parallel producer keeps its own accumulator.
+
+    Args:
+        indices (dict): Dictionary describing the indices used for calculating the Dice Similarity Coefficient.
+            Example: `{"lung_left": 1, "lung_right": 2}`.
+        engine (str): The engine used for counting voxels, one of "loop", "histogram" or "bbox". Default: `'loop'`.
+        keep_cases (bool): If `True`, also keeps the metrics of each case, which are returned by `metrics`. The case ids
+            must then be unique, including across merged accumulators. Cases added without an id are named after their
+            position in this accumulator, so accumulators which are merged should be given explicit case ids.
+            Default: `False`.
+
+    Example:
+        >>> accumulator = DiceAccumulator({'lung': 1, 'heart': 2})
+        >>> for gt, pred, case_id in cases:
+        ...     accumulator.add(gt, pred, case_id)
+        >>> accumulator.metrics()['Global dice']
+    """
+
+    def __init__(self, indices: dict, engine: str = 'loop', keep_cases: bool = False):
+        assert all([isinstance(x, int) for x in indices.values()]), \
+            f'Indices must be integers, found {indices.values()}.'
+        assert engine in ENGINES, f'Engine must be one of {ENGINES}, is {engine}.'
+        self.indices = dict(indices)
+        self.engine = engine
+        self.keep_cases = keep_cases
+        self.cases = {}
+        self.num_cases = 0
+        labels = len(indices)
+        self.common_voxels = np.zeros(labels, dtype=np.int64)
+        self.all_voxels = np.zeros(labels, dtype=np.int64)
+        self.gt_voxels = np.zeros(labels, dtype=np.int64)
+        self.dice_sum = np.zeros(labels, dtype=np.float64)
+        self.weighted_dice_sum = np.zeros(labels, dtype=np.float64)
+        self.weights_sum = 0
+
+    def add(self, gt: ndarray, pred: ndarray, case_id: Union[str, None] = None):
+        """ Evaluates a pair of GT and prediction and accumulates its metrics.
+        """
+        common_voxels, all_voxels, gt_voxels, _ = multi_class_dice(gt, pred, tuple(self.indices.values()), self.engine)
+        self.add_counts(common_voxels, all_voxels, gt_voxels, case_id)
+
+    def add_counts(self, common_voxels: ndarray, all_voxels: ndarray, gt_voxels: ndarray,
+                   case_id: Union[str, None] = None):
+        """ Accumulates the metrics of a case from its common, both and GT voxel counts, as returned by
+        `multi_class_dice`.
+        """
+        if self.keep_cases:
+            case_id = str(self.num_cases) if case_id is None else case_id
+            assert case_id not in self.cases, f'Case {case_id} was already accumulated.'
+        scores = dice_from_counts(common_voxels, all_voxels)
+        weight = np.sum(gt_voxels)
+        self.num_cases += 1
+        self.common_voxels += common_voxels
+        self.all_voxels += all_voxels
+        self.gt_voxels += gt_voxels
+        self.dice_sum += scores
+        self.weighted_dice_sum += weight * scores
+        self.weights_sum += weight
+        if self.keep_cases:
+            self.cases[case_id] = {label: score for label, score in zip(self.indices.keys(), scores)}
+            self.cases[case_id]['Mean'] = np.mean(scores)
+            self.cases[case_id]['Weighted mean'] = average(scores, weights=gt_voxels)
+
+    def update(self, cases: Iterable[Tuple[ndarray, ndarray, Union[str, None]]]) -> 'DiceAccumulator':
+        """ Accumulates the metrics of (GT, prediction, case id) tuples, e.g. from a generator.
+        """
+        for gt, pred, case_id in cases:
+            self.add(gt, pred, case_id)
+        return self
+
+    def merge(self, other: 'DiceAccumulator') -> 'DiceAccumulator':
+        """ Merges the metrics accumulated by `other` into this accumulator. Both accumulators must use the same
+        indices, in the same order, and both must keep the metrics of each case or neither, in which case their case
+        ids must be different.
+        """
+        assert list(self.indices.items()) == list(other.indices.items()), \
+            f'Cannot merge accumulators with different indices: {self.indices} and {other.indices}.'
+        assert self.keep_cases == other.keep_cases, \
+            'Cannot merge an accumulator keeping the metrics of each case with one which does not.'
+        duplicates = sorted(set(self.cases) & set(other.cases))
+        assert len(duplicates) == 0, f'Cannot merge accumulators with the same case ids: {duplicates[:10]}.'
+        self.num_cases += other.num_cases
+        self.common_voxels += other.common_voxels
+        self.all_voxels += other.all_voxels
+        self.gt_voxels += other.gt_voxels
+        self.dice_sum += other.dice_sum
+        self.weighted_dice_sum += other.weighted_dice_sum
+        self.weights_sum += other.weights_sum
+        if self.keep_cases:
+            self.cases.update(other.cases)
+        return self
+
+    def __iadd__(self, other: 'DiceAccumulator') -> 'DiceAccumulator':
+        return self.merge(other)
+
+    def metrics(self) -> dict:
+        """ Returns the per-label Mean, Weighted mean and Global Dice of the accumulated cases, in the same format as
+        `dice_metrics`. The metrics of each case are also included when using `keep_cases`.
+        """
+        assert self.num_cases > 0, 'No cases were accumulated.'
+        index_keys = self.indices.keys()
+        metrics = dict(self.cases)
+
+        scores = self.dice_sum / self.num_cases
+        metrics['Mean'] = {label: score for label, score in zip(index_keys, scores)}
+        metrics['Mean']['Mean'] = np.mean(scores)
+        metrics['Mean']['Weighted mean'] = average(scores, weights=self.gt_voxels)
+
+        if self.weights_sum == 0:
+            scores = self.dice_sum / self.num_cases
+        else:
+            scores = self.weighted_dice_sum / self.weights_sum
+        metrics['Weighted mean'] = {label: score for label, score in zip(index_keys, scores)}
+        metrics['Weighted mean']['Mean'] = np.mean(scores)
+        metrics['Weighted mean']['Weighted mean'] = average(scores, weights=self.gt_voxels)
+
+        scores = dice_from_counts(self.common_voxels, self.all_voxels)
+        metrics['Global dice'] = {label: score for label, score in zip(index_keys, scores)}
+        metrics['Global dice']['Mean'] = np.mean(scores)
+        metrics['Global dice']['Weighted mean'] = average(scores, weights=self.gt_voxels)
+        return metrics
@@ -0,0 +1,176 @@
+import argparse
+import json
+import os.path
+import platform
+import tempfile
+import time
+from typing import Callable, List, Sequence, Tuple
+
+import SimpleITK as sitk
+import numpy as np
+from numpy import ndarray
+
+from dice_score_3d.metrics import ENGINES, execute_evaluate_predictions, multi_class_dice, stack_scores, \
+    summarize_metrics
+
+
+def create_label_map(size: Sequence[int], labels: int, sparsity: float, dtype: np.dtype,
+                     rng: np.random.Generator) -> ndarray:
+    """ Creates a synthetic label map with one randomly placed ellipsoid for each label. The ellipsoids cover
+    approximately `sparsity` of the volume, the rest being background.
+    """
+    volume = np.zeros(size, dtype=dtype)
+    shape = np.array(size)
+    radius = (3 * sparsity * np.prod(shape) / labels / (4 * np.pi)) ** (1 / 3)
+    for label in range(1, labels + 1):
+        aspect = rng.uniform(0.6, 1.5, size=3)
+        radii = np.clip(radius * aspect / np.prod(aspect) ** (1 / 3), 1, shape / 2)
+        center = rng.uniform(radii, shape - radii)
+        lower = np.floor(center - radii).astype(int)
+        upper = np.ceil(center + radii).astype(int)
+        grid = np.ogrid[tuple(slice(a, b) for a, b in zip(lower, upper))]
+        mask = sum(((x + 0.5 - c) / r) ** 2 for x, c, r in zip(grid, center, radii)) <= 1
+        volume[tuple(slice(a, b) for a, b in zip(lower, upper))][mask] = label
+    return volume
+
+
+def create_prediction(gt: ndarray, rng: np.random.Generator, max_shift: int = 2) -> ndarray:
+    """ Creates a synthetic prediction by shifting the GT by a few voxels along each axis.
+    """
+    shift = tuple(rng.integers(-max_shift, max_shift + 1, size=gt.ndim))
+    return np.roll(gt, shift, axis=tuple(range(gt.ndim)))
+
+
+def write_cases(directory: str, cases: int, size: Sequence[int], labels: int, sparsity: float, dtype: np.dtype,
+                suffix: str, compress: bool, seed: int) -> Tuple[List[str], List[str]]:
+    """ Writes pairs of synthetic GT and predictions, returning their paths.
+    """
+    rng = np.random.default_rng(seed)
+    gt_files = []
+    pred_files = []
+    for i in range(cases):
+        gt = create_label_map(size, labels, sparsity, dtype, rng)
+        for volume, name, files in ((gt, 'gt', gt_files), (create_prediction(gt, rng), 'pred', pred_files)):
+            path = os.path.join(directory, f'{name}_{i}{suffix}')
+            sitk.WriteImage(sitk.GetImageFromArray(volume), path, compress)
+            files.append(path)
+    return gt_files, pred_files
+
+
+def best_time(function: Callable, repeats: int) -> float:
+    """ Returns the best wall time of `repeats` calls of `function`.
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def time_stages(gt_files: List[str], pred_files: List[str], dtype: np.dtype, indices: Sequence[int],
+                engines: Sequence[str], repeats: int) -> dict:
+    """ Times the read, reorient, cast and score stages separately, summed over all the cases.
+    """
+    stages = {'read': 0.0, 'reorient': 0.0, 'cast': 0.0, 'score': {engine: 0.0 for engine in engines}}
+    for gt, pred in zip(gt_files, pred_files):
+        arrays = []
+        for path in (gt, pred):
+            stages['read'] += best_time(lambda: sitk.ReadImage(path), repeats)
+            img = sitk.ReadImage(path)
+            stages['reorient'] += best_time(lambda: sitk.DICOMOrient(img), repeats)
+            stages['cast'] += best_time(lambda: sitk.GetArrayFromImage(img).astype(dtype, copy=False), repeats)
+            arrays.append(sitk.GetArrayFromImage(img).astype(dtype, copy=False))
+        for engine in engines:
+            stages['score'][engine] += best_time(lambda: multi_class_dice(*arrays, indices, engine), repeats)
+    return stages
+
+
+def run_benchmark(directory: str, cases: int, size: Sequence[int], labels: int, sparsity: float, dtype: str,
+                  suffix: str, compress: bool, engines: Sequence[str], num_workers: int, repeats: int,
+                  seed: int = 0) -> dict:
+    """ Writes synthetic cases to `directory` and times each evaluation stage, then the whole evaluation using both the
+    serial path and the process pool path with `num_workers` processes.
+    """
+    dtype = np.uint8 if dtype == 'uint8' else np.uint16
+    gt_files, pred_files = write_cases(directory, cases, size, labels, sparsity, dtype, suffix, compress, seed)
+    indices = {str(x): x for x in range(1, labels + 1)}
+    stages = time_stages(gt_files, pred_files, dtype, tuple(indices.values()), engines, repeats)
+
+    cases = [(x,) for x in pred_files]
+    end_to_end = {}
+    for engine in engines:
+        end_to_end[engine] = {'serial': best_time(lambda: execute_evaluate_predictions(
+            gt_files, cases, False, dtype, tuple(indices.values()), 0, engine), repeats)}
+        if num_workers > 0:
+            end_to_end[engine]['process_pool'] = best_time(lambda: execute_evaluate_predictions(
+                gt_files, cases, False, dtype, tuple(indices.values()), num_workers, engine), repeats)
+
+    scores = stack_scores([x[0] for x in execute_evaluate_predictions(
+        gt_files, cases, False, dtype, tuple(indices.values()), 0, engines[0])])
+    stages['aggregate'] = best_time(lambda: summarize_metrics(pred_files, *scores, indices), repeats)
+    return {
+        'labels': labels,
+        'file_size': sum(os.path.getsize(x) for x in gt_files + pred_files),
+        'stages': stages,
+        'end_to_end': end_to_end,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DICE Score 3D benchmark')
+    parser.add_argument('-output', type=str, required=False, default=None,
+                        help='The json file where the benchmark results are written. If missing, the results are '
+                             'printed to console.')
+    parser.add_argument('-cases', type=int, required=False, default=4,
+                        help='Number of synthetic cases. Default: 4.')
+    parser.add_argument('-size', type=int, nargs=3, required=False, default=[128, 256, 256],
+                        help='Size of the synthetic volumes, in ndarray (z, y, x) order. Default: 128 256 256.')
+    parser.add_argument('-labels', type=int, nargs='+', required=False, default=[2, 8, 32],
+                        help='Number of labels of the synthetic volumes. The benchmark is run for each value, showing '
+                             'how the evaluation scales with the number of labels. Default: 2 8 32.')
+    parser.add_argument('-sparsity', type=float, required=False, default=0.1,
+                        help='Fraction of the volume covered by foreground labels. Default: 0.1.')
+    parser.add_argument('-dtype', type=str, required=False, default='uint8', choices=['uint8', 'uint16'],
+                        help='Data type of the synthetic volumes. Default: uint8.')
+    parser.add_argument('-suffix', type=str, required=False, default='.nii.gz',
+                        help='File format of the synthetic volumes. Default: .nii.gz.')
+    parser.add_argument('--compress', action='store_true', default=False,
+                        help='Compresses the synthetic volumes for file formats with optional compression (.nrrd, '
+                             '.mha).')
+    parser.add_argument('-engines', type=str, nargs='+', required=False, default=list(ENGINES), choices=ENGINES,
+                        help='The engines used for counting voxels. Default: all.')
+    parser.add_argument('-num_workers', type=int, required=False, default=os.cpu_count(),
+                        help='Number of parallel processes used for timing the process pool path. If 0, only the '
+                             'serial path is timed. Default: the number of CPUs.')
+    parser.add_argument('-repeats', type=int, required=False, default=3,
+                        help='Number of repetitions of each measurement, keeping the best time. Default: 3.')
+    parser.add_argument('-seed', type=int, required=False, default=0,
+                        help='Seed of the synthetic volumes. Default: 0.')
+    args = parser.parse_args()
+
+    results = {
+        'config': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'SimpleITK': sitk.Version.VersionString(),
+            'cpu_count': os.cpu_count(),
+        },
+        'runs': [],
+    }
+    for labels in args.labels:
+        with tempfile.TemporaryDirectory() as directory:
+            results['runs'].append(run_benchmark(directory, args.cases, args.size, labels, args.sparsity, args.dtype,
+                                                 args.suffix, args.compress, args.engines, args.num_workers,
+                                                 args.repeats, args.seed))
+    json_str = json.dumps(results, indent=2)
+    if args.output is None:
+        print(json_str)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(json_str)
+
+
+if __name__ == '__main__':
+    main()
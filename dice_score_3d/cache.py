@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import BinaryIO, Callable, Sequence, Tuple, Union
+
+import numpy as np
+from numpy import ndarray
+
+
+def file_identity(path: str) -> Tuple[str, int, int]:
+    """ Identifies a file by its absolute path, size and modification time.
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def evict_least_recently_used(cache_dir: str, suffix: str, sidecars: Sequence[str] = (),
+                              max_entries: Union[int, None] = None, max_bytes: Union[int, None] = None):
+    """ Removes the least recently used entries (the files with `suffix`, together with their sidecar files) until at
+    most `max_entries` entries are left and their total size is at most `max_bytes`.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(suffix):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # Evicted by another process
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    entries.sort()
+    total = sum(x[1] for x in entries)
+    count = len(entries)
+    for _, size, path in entries:
+        if (max_entries is None or count <= max_entries) and (max_bytes is None or total <= max_bytes):
+            break
+        for file in [path] + [path[:-len(suffix)] + x for x in sidecars]:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+        total -= size
+        count -= 1
+
+
+def atomic_write(path: str, write: Callable[[BinaryIO], None]):
+    """ Writes a file through a temporary file which is then renamed, so readers never see partially written files.
+    """
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class ResultCache:
+    """ On-disk cache of the per-case voxel counts (common, both, GT voxels) of pairs of prediction and GT.
+
+    Each entry is keyed by the identity (path, size and modification time) of the GT and prediction files, the
+    reorientation flag, the data type and the indices (labels), so changing any of them invalidates the entry. The
+    least recently used entries are evicted when the number of entries exceeds `max_entries`.
+
+    Args:
+        cache_dir (str): The directory where the cache entries are stored. Created if it does not exist.
+        max_entries (int): The maximum number of entries kept in the cache. Default: `100000`.
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int = 100000):
+        assert max_entries > 0, f'The maximum number of cache entries must be positive, is {max_entries}.'
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(gt: str, pred: str, reorient: bool, dtype: np.dtype, indices: Sequence[int]) -> str:
+        """ Creates the cache key of a pair of prediction and GT.
+        """
+        identity = [file_identity(gt), file_identity(pred), reorient, np.dtype(dtype).name, [int(x) for x in indices]]
+        return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key: str) -> Union[Tuple[ndarray, ndarray, ndarray], None]:
+        """ Returns the cached common, both and GT voxels, or `None` if the key is not cached.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                counts = data['common_voxels'], data['all_voxels'], data['gt_voxels']
+            os.utime(path)  # Marks the entry as recently used, fails if another process just evicted it
+        except (OSError, KeyError, ValueError):
+            return None
+        return counts
+
+    def put(self, key: str, common_voxels: ndarray, all_voxels: ndarray, gt_voxels: ndarray):
+        """ Stores the common, both and GT voxels of a pair of prediction and GT.
+        """
+        atomic_write(self._path(key), lambda f: np.savez(f, common_voxels=common_voxels, all_voxels=all_voxels,
+                                                         gt_voxels=gt_voxels))
+
+    def evict(self):
+        """ Removes the least recently used entries until at most `max_entries` are left.
+        """
+        evict_least_recently_used(self.cache_dir, '.npz', max_entries=self.max_entries)
+
+    def clear(self):
+        """ Removes all the entries.
+        """
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                os.remove(entry.path)
+
+
+class VolumeCache:
+    """ On-disk cache of decoded segmentation masks. The first read of a volume stores the decoded and cast array
+    (reoriented only when read with `reorient`, see `read_volume`) uncompressed in a .npy file, together with a .json
+    sidecar file describing its geometry. Later reads memory-map the .npy file instead of decoding the volume again.
+    The evaluation reads the volumes without `reorient` and aligns the cached arrays afterwards (see `align_masks`).
+
+    Each entry is keyed by the identity (path, size and modification time) of the volume, the reorientation flag and
+    the data type, so changing the volume invalidates the entry. The least recently used entries are evicted when the
+    total size of the cache exceeds `max_size`.
+
+    Args:
+        cache_dir (str): The directory where the cache entries are stored. Created if it does not exist.
+        max_size (float): The maximum total size of the cached arrays, in GB. Default: `10.0`.
+    """
+
+    def __init__(self, cache_dir: str, max_size: float = 10.0):
+        assert max_size > 0, f'The maximum size of the volume cache must be positive, is {max_size}.'
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(path: str, reorient: bool, dtype: np.dtype) -> str:
+        """ Creates the cache key of a volume.
+        """
+        identity = [file_identity(path), reorient, np.dtype(dtype).name]
+        return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key: str) -> Union[Tuple[ndarray, dict], None]:
+        """ Returns the memory-mapped array and the geometry of a cached volume, or `None` if the key is not cached.
+        """
+        path = self._path(key)
+        try:
+            with open(path[:-len('.npy')] + '.json', 'r') as f:
+                geometry = json.load(f)
+            array = np.load(path, mmap_mode='r')
+            os.utime(path)  # Marks the entry as recently used, fails if another process just evicted it
+        except (OSError, ValueError):
+            return None
+        return array, geometry
+
+    def put(self, key: str, array: ndarray, geometry: dict):
+        """ Stores the decoded array and the geometry of a volume, then evicts the least recently used entries.
+        """
+        path = self._path(key)
+        atomic_write(path[:-len('.npy')] + '.json', lambda f: f.write(json.dumps(geometry).encode()))
+        atomic_write(path, lambda f: np.save(f, np.ascontiguousarray(array)))
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the total size is at most `max_size`.
+        """
+        evict_least_recently_used(self.cache_dir, '.npy', sidecars=('.json',), max_bytes=int(self.max_size * 2 ** 30))
+
+    def clear(self):
+        """ Removes all the entries.
+        """
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy') or entry.name.endswith('.json'):
+                os.remove(entry.path)
@@ -1,12 +1,73 @@
 import argparse
 import json
 import os.path
+import sys
+from typing import Dict, List, Tuple
 
-from dice_score_3d import dice_metrics
+from dice_score_3d import dice_metrics, merge_partials, watch_predictions
+
+
+def parse_model(value: str) -> Tuple[str, str]:
+    """ Parses a "name=path" model description. A path without a name is named after its last component.
+    """
+    if '=' in value and not os.path.exists(value):
+        name, path = value.split('=', 1)
+        return name, path
+    return os.path.basename(os.path.normpath(value)), value
+
+
+def parse_models(values: List[str]) -> Dict[str, str]:
+    """ Parses several model descriptions (see `parse_model`). When the names collide, the unnamed models are named
+    after their full path instead, as done by `model_names`. The model names must be unique.
+    """
+    models = [parse_model(x) for x in values]
+    if len({name for name, _ in models}) < len(models):
+        named = ['=' in x and not os.path.exists(x) for x in values]
+        models = [(name if is_named else path, path) for (name, path), is_named in zip(models, named)]
+    names = [name for name, _ in models]
+    duplicates = sorted({x for x in names if names.count(x) > 1})
+    assert len(duplicates) == 0, f'Duplicate model names found: {duplicates}.'
+    return dict(models)
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """ Parses an "index/count" shard description.
+    """
+    try:
+        index, count = map(int, value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Shard must be "index/count", is {value}')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'Shard index must be between 0 and the shard count {count}, is {index}')
+    return index, count
+
+
+def merge_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='dice_score_3d merge',
+                                     description='Merges the partial results of a sharded DICE Score 3D evaluation')
+    parser.add_argument('partials', type=str, nargs='+',
+                        help='Paths to the partial results files written by each shard using -partial.')
+    parser.add_argument('-output', type=str, required=True,
+                        help='The output path to write the merged metrics. Can be a csv or json file, depending on '
+                             'extension. Example: "results.csv", "results.json".')
+    parser.add_argument('--console', action='store_true', default=False,
+                        help='Also prints the Dice metrics to console.')
+    parser.add_argument('-bootstrap', type=int, required=False, default=0,
+                        help='If positive, the number of bootstrap resamples of the merged cases used for computing '
+                             'confidence intervals of the mean, weighted mean and Global Dice. Default: 0.')
+    parser.add_argument('-confidence', type=float, required=False, default=0.95,
+                        help='The confidence level of the bootstrap confidence intervals. Default: 0.95.')
+    args = parser.parse_args(argv)
+    merge_partials(args.partials, args.output, args.console, args.bootstrap, args.confidence)
 
 
 def main():
-    parser = argparse.ArgumentParser(description='DICE Score 3D')
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge_main(sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(description='DICE Score 3D',
+                                     epilog='Use "dice_score_3d merge -h" for merging the partial results of sharded '
+                                            'evaluations.')
     parser.add_argument('ground_truths', type=str,
                         help='Path to Ground Truth. Can be a single file or a folder with all the GT volumes. '
                              'The number of GT files must match the number of predictions, '
@@ -14,16 +75,19 @@ def main():
                              'When passing a folder of GT files, the name of the GT files must match the name of the '
                              'predictions. This is not applicable when passing a single file. '
                              'Supported file formats: .nii, .nii.gz, .nrrd, .mha, .gipl.')
-    parser.add_argument('predictions', type=str,
-                        help='Path to Ground Truth. Can be a single file or a folder with all the predicted volumes. '
-                             'The number of prediction files must match the number of GT files, '
+    parser.add_argument('predictions', type=str, nargs='+',
+                        help='Path to the predictions. Can be a single file or a folder with all the predicted '
+                             'volumes. The number of prediction files must match the number of GT files, '
                              'unless `ignore_gt_size` is used. '
                              'When passing a folder of prediction files, the name of the prediction files must match '
                              'the name of the GT files. This is not applicable when passing a single file. '
-                             'Supported file formats: .nii, .nii.gz, .nrrd, .mha, .gipl.')
-    parser.add_argument('-output', type=str, required=True,
+                             'Supported file formats: .nii, .nii.gz, .nrrd, .mha, .gipl. '
+                             'Several paths can be passed for evaluating several models at once, each GT being read '
+                             'only once. A model can be named using "name=path", otherwise it is named after the last '
+                             'component of its path.')
+    parser.add_argument('-output', type=str, required=False, default=None,
                         help='The output path to write the computed metrics. Can be a csv or json file, depending on '
-                             'extension. Example: "results.csv", "results.json".')
+                             'extension. Example: "results.csv", "results.json". Required unless -partial is used.')
     parser.add_argument('-indices', type=str, required=True,
                         help='Path to the json file describing the indices used for calculating the Dice Similarity '
                              'Coefficient. Can also be a json string. Only the indices present in the json are '
@@ -49,7 +113,93 @@ def main():
                         help='Also prints the Dice metrics to console.')
     parser.add_argument('--ignore_gt_size', action='store_true', default=False,
                         help='Allows the presence of additional GT files in the GT folder.')
+    parser.add_argument('-engine', type=str, required=False, default='loop', choices=['loop', 'histogram', 'bbox'],
+                        help='The engine used for counting voxels. "loop" builds two boolean masks for each label, '
+                             'while "histogram" reads each voxel once and derives the counts of all labels from a '
+                             'joint histogram, which is faster when evaluating many labels. "bbox" only scans the '
+                             'overlap of the GT and prediction bounding boxes of each label, which is faster for small '
+                             'structures in large, mostly-background volumes. Default: loop.')
+    parser.add_argument('-cache_dir', type=str, required=False,
+                        default=os.path.join(os.path.expanduser('~'), '.cache', 'dice_score_3d'),
+                        help='Directory of the persistent result cache. The voxel counts of each pair of prediction '
+                             'and GT are cached and only the pairs which changed are evaluated again. '
+                             'Default: ~/.cache/dice_score_3d.')
+    parser.add_argument('-cache_size', type=int, required=False, default=100000,
+                        help='The maximum number of entries kept in the result cache. The least recently used entries '
+                             'are evicted first. Default: 100000.')
+    parser.add_argument('--no_cache', action='store_true', default=False,
+                        help='Disables the result cache.')
+    parser.add_argument('-prefetch', type=int, required=False, default=0,
+                        help='When evaluating sequentially, the number of pairs of prediction and GT read ahead by '
+                             'background threads while the current pair is scored. The peak memory grows with the '
+                             'number of prefetched pairs. Default: 0.')
+    parser.add_argument('-slab_size', type=int, required=False, default=0,
+                        help='If positive, the volumes are read and evaluated in slabs of this many slices along the z '
+                             'axis, bounding the peak memory by the slab size instead of the volume size for file '
+                             'formats which support streaming (.mha, .nii, .nii.gz or uncompressed .nrrd). Other '
+                             'formats are read whole. Cannot be used with --reorient or -prefetch. Default: 0.')
+    parser.add_argument('-profile', type=str, required=False, default=None,
+                        help='Path to a json trace file. If given, the evaluation is profiled and the time spent '
+                             'reading, reorienting, casting and scoring each case, the number of bytes read and the '
+                             'peak array memory are written to the trace file, together with a summary of where the '
+                             'time went and which cases were outliers.')
+    parser.add_argument('-num_threads', type=int, required=False, default=1,
+                        help='Number of threads used to evaluate each volume, which is split into chunks. Useful when '
+                             'evaluating few, large volumes. Can be combined with -num_workers, in which case the '
+                             'number of threads is limited so that the CPUs are not oversubscribed. If 0, uses all the '
+                             'CPUs left available by -num_workers. Default: 1.')
+    parser.add_argument('-volume_cache_dir', type=str, required=False, default=None,
+                        help='Directory of the persistent cache of decoded volumes. Each volume is stored after '
+                             'decoding as an uncompressed .npy file, which is memory-mapped instead of decoding the '
+                             'volume again in later runs, e.g. when evaluating new predictions against the same GT. '
+                             'Cannot be used with -slab_size. If missing, the cache is not used.')
+    parser.add_argument('-volume_cache_size', type=float, required=False, default=10.0,
+                        help='The maximum total size of the decoded volume cache, in GB. The least recently used '
+                             'volumes are evicted first. Default: 10.')
+    parser.add_argument('-shard', type=parse_shard, required=False, default=None,
+                        help='Evaluates only a deterministic subset of the cases, given as "index/count" with the '
+                             'index starting at 0. Shard i evaluates the cases i, i + count, i + 2 * count, ... so '
+                             'that count shards, e.g. running on different machines, evaluate each case once. '
+                             'Example: "3/16".')
+    parser.add_argument('-partial', type=str, required=False, default=None,
+                        help='Path to a JSON lines file where the voxel counts and Dice scores of each case are '
+                             'appended as soon as the case is evaluated, so that the results are kept if the '
+                             'evaluation is interrupted. The partial results of all the shards are merged into the '
+                             'final metrics using "dice_score_3d merge".')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Skips the cases already found in the -partial file, e.g. written by an interrupted '
+                             'evaluation, and appends the remaining cases to it.')
+    parser.add_argument('-surface_tolerance', type=float, required=False, default=None,
+                        help='If given, the 95th percentile Hausdorff distance (HD95) and the normalized surface Dice '
+                             '(NSD) at this tolerance, in mm, are also computed for each label, and their per-label '
+                             'means over the cases are added as the "HD95" and "NSD" rows of the results. The result '
+                             'cache is not used for these metrics. Cannot be used with -slab_size.')
+    parser.add_argument('-bootstrap', type=int, required=False, default=0,
+                        help='If positive, the number of bootstrap resamples of the cases used for computing '
+                             'confidence intervals of the mean, weighted mean and Global Dice of each label. The '
+                             'intervals are computed from the voxel counts of each case, without reading the volumes '
+                             'again, and are added as the "... CI low" and "... CI high" rows of the results. '
+                             'Default: 0.')
+    parser.add_argument('-confidence', type=float, required=False, default=0.95,
+                        help='The confidence level of the bootstrap confidence intervals. Default: 0.95.')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='Watches the predictions folder and evaluates each prediction as soon as it is completely '
+                             'written, refreshing the output file after each poll which evaluated new predictions. '
+                             'Stops when all the GT files have a prediction, or after -watch_timeout. Only -output, '
+                             '--reorient, -dtype, -prefix, -suffix, --console, -engine and -num_threads are used in '
+                             'this mode.')
+    parser.add_argument('-poll_interval', type=float, required=False, default=10.0,
+                        help='When watching, the number of seconds between two polls of the predictions folder. A '
+                             'prediction is evaluated once its size and modification time are unchanged between two '
+                             'polls. Default: 10.')
+    parser.add_argument('-watch_timeout', type=float, required=False, default=None,
+                        help='When watching, stops when no prediction was added, changed or removed for this many '
+                             'seconds. If missing, watches until all the GT files have a prediction.')
     args = parser.parse_args()
+    if args.output is None and args.partial is None:
+        parser.error('at least one of -output and -partial is required')
+    if args.resume and args.partial is None:
+        parser.error('--resume requires -partial')
     if os.path.isfile(args.indices):
         with open(args.indices, 'r') as f:
             args.indices = json.load(f)
@@ -58,8 +208,25 @@ def main():
         # TODO: Check json parse error
         args.indices = json.loads(args.indices)
 
+    if any('=' in x and not os.path.exists(x) for x in args.predictions):
+        args.predictions = parse_models(args.predictions)
+    elif len(args.predictions) == 1:
+        args.predictions = args.predictions[0]
+
+    if args.watch:
+        if not isinstance(args.predictions, str):
+            parser.error('--watch requires a single predictions folder')
+        if args.output is None:
+            parser.error('--watch requires -output')
+        watch_predictions(args.ground_truths, args.predictions, args.output, args.indices, args.reorient, args.dtype,
+                          args.prefix, args.suffix, args.console, args.engine, args.num_threads, args.poll_interval,
+                          args.watch_timeout)
+        return
     dice_metrics(args.ground_truths, args.predictions, args.output, args.indices, args.reorient, args.dtype,
-                 args.prefix, args.suffix, args.num_workers, args.console, args.ignore_gt_size)
+                 args.prefix, args.suffix, args.num_workers, args.console, args.ignore_gt_size, args.engine,
+                 None if args.no_cache else args.cache_dir, args.cache_size, args.prefetch, args.slab_size,
+                 args.profile, args.num_threads, args.volume_cache_dir, args.volume_cache_size, args.shard,
+                 args.partial, args.resume, args.surface_tolerance, args.bootstrap, args.confidence)
 
 
 if __name__ == '__main__':
@@ -1,33 +1,54 @@
 import json
 import os.path
-from typing import List, Sequence, Tuple, Union
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple, Union
 
+import SimpleITK as sitk
 import numpy as np
 from numpy import ndarray
 from tqdm import tqdm
-from tqdm.contrib.concurrent import process_map
 
-from dice_score_3d.reader import read_mask
+from dice_score_3d.cache import ResultCache, VolumeCache
+from dice_score_3d.partial import append_record, case_record, json_compatible, partial_header, read_partial, \
+    record_counts, record_surface_metrics, write_partial
+from dice_score_3d.profiling import STAGES, format_summary, timed, write_profile
+from dice_score_3d.reader import align_axes, align_masks, aligned_spacing, prefetch_masks, read_header, read_slabs, \
+    read_volume, track_array_bytes
 
+ENGINES = ('loop', 'histogram', 'bbox')
 
-def dice_metrics(ground_truths: str, predictions: str, output_path: Union[str, None], indices: dict,
+
+def dice_metrics(ground_truths: str, predictions: Union[str, Sequence[str], Dict[str, str]],
+                 output_path: Union[str, None], indices: dict,
                  reorient: bool = False, dtype: str = 'uint8', prefix: str = '', suffix: str = '.nii.gz',
-                 num_workers: int = 0, console: bool = False, ignore_gt_size: bool = False) -> dict:
+                 num_workers: int = 0, console: bool = False, ignore_gt_size: bool = False,
+                 engine: str = 'loop', cache_dir: Union[str, None] = None, cache_size: int = 100000,
+                 prefetch: int = 0, slab_size: int = 0, profile_path: Union[str, None] = None,
+                 num_threads: int = 1, volume_cache_dir: Union[str, None] = None,
+                 volume_cache_size: float = 10.0, shard: Union[Tuple[int, int], None] = None,
+                 partial_path: Union[str, None] = None, resume: bool = False,
+                 surface_tolerance: Union[float, None] = None, bootstrap: int = 0,
+                 confidence: float = 0.95) -> dict:
     """ Calculates Dice metrics for pairs of predictions and GT, writing the aggregated results in a csv or json file
-    and returning them as a `dict`.
+    and returning them as a `dict`. When several prediction sets (models) are given, each GT is read only once and
+    evaluated against the predictions of every model, and the returned `dict` maps each model name to its metrics.
 
     Args:
         ground_truths (str): Path to Ground Truth. Can be a single file or a folder with all the GT volumes. The number
             of GT files must match the number of predictions, unless `ignore_gt_size` is used. When passing a folder of
             GT files, the name of the GT files must match the name of the predictions. This is not applicable when
             passing a single file. Supported file formats: .nii, .nii.gz, .nrrd, .mha, .gipl.
-        predictions (str): Path to Ground Truth. Can be a single file or a folder with all the predicted volumes. The
-            number of prediction files must match the number of GT files, unless `ignore_gt_size` is used. When passing
-            a folder of prediction files, the name of the prediction files must match the name of the GT files. This is
-            not applicable when passing a single file. Supported file formats: .nii, .nii.gz, .nrrd, .mha, .gipl.
+        predictions (Union[str, Sequence[str], Dict[str, str]]): Path to the predictions. Can be a single file or a
+            folder with all the predicted volumes. The number of prediction files must match the number of GT files,
+            unless `ignore_gt_size` is used. When passing a folder of prediction files, the name of the prediction files
+            must match the name of the GT files. This is not applicable when passing a single file. Supported file
+            formats: .nii, .nii.gz, .nrrd, .mha, .gipl. Can also be a sequence of paths or a dictionary mapping model
+            names to paths, for evaluating several models at once. The models are named after the last component of
+            their path when passing a sequence. All models must contain the same prediction files.
         output_path (Union[str, None]): The output path to write the computed metrics. Can be a csv or json file,
             depending on extension. Example: "results.csv", "results.json". If `None`, the metrics will not be written
-            to a file.
+            to a file. When evaluating several models, the csv file has an additional "Model" column.
         indices (dict): Dictionary describing the indices used for calculating the Dice Similarity Coefficient.
             Example: `{"lung_left": 1, "lung_right": 2}`.
         reorient (bool): If `True`, reorients both the GT and the prediction to the default "LPS" orientation before
@@ -42,8 +63,162 @@ def dice_metrics(ground_truths: str, predictions: str, output_path: Union[str, N
             `0`.
         console (bool): If `True`, also prints the Dice metrics to console. Default: `False`.
         ignore_gt_size (bool): If `True`, allows the presence of additional GT files in the GT folder. Default: `False`.
+        engine (str): The engine used for counting voxels. "loop" builds two boolean masks for each label, while
+            "histogram" reads each voxel once and derives the counts of all labels from a joint histogram of (GT,
+            prediction) pairs, which is faster when evaluating many labels. "bbox" collects the foreground voxels and
+            the bounding box of each label and only scans the overlap of the GT and prediction bounding boxes, which is
+            faster for small structures in large, mostly-background volumes. All engines return the same values.
+            Default: `'loop'`.
+        cache_dir (Union[str, None]): Directory of the persistent result cache. The voxel counts of each pair of
+            prediction and GT are cached using the path, size and modification time of both files, the reorientation
+            flag, the data type and the indices, and only the pairs which changed are evaluated again. If `None`, the
+            cache is not used. Default: `None`.
+        cache_size (int): The maximum number of entries kept in the result cache. The least recently used entries are
+            evicted first. Default: `100000`.
+        prefetch (int): When evaluating sequentially (`num_workers` is `0`), the number of pairs of prediction and GT
+            read ahead by background threads while the current pair is scored, overlapping the decompression with the
+            computation. The peak memory grows with the number of prefetched pairs. If `0`, the pairs are read and
+            scored in strict sequence. Default: `0`.
+        slab_size (int): If positive, the volumes are read and evaluated in slabs of `slab_size` slices along the z
+            axis, summing the voxel counts of each slab. The peak memory is then bounded by the slab size instead of the
+            volume size for file formats which support streaming (.mha, .nii, .nii.gz or uncompressed .nrrd, see
+            `read_slabs`), while other formats are read whole. Cannot be used with `reorient` or `prefetch`. Default:
+            `0`.
+        profile_path (Union[str, None]): If given, profiles the evaluation and writes a json trace file with the time
+            spent reading, reorienting, casting and scoring each case, the number of bytes read and decoded and the peak
+            array memory of each case, together with a summary of where the time went and which cases were outliers.
+            Cached cases are not profiled. Default: `None`.
+        num_threads (int): Number of threads used to evaluate each volume, which is split into chunks along the first
+            axis. Useful when evaluating few, large volumes. Can be combined with `num_workers`, in which case the
+            number of threads is limited so that `num_workers * num_threads` does not exceed the number of CPUs. If
+            `0`, uses all the CPUs left available by `num_workers`. Default: `1`.
+        volume_cache_dir (Union[str, None]): Directory of the persistent cache of decoded volumes. Each volume is stored
+            after decoding and casting, in the voxel order of its file, as an uncompressed .npy file, which is
+            memory-mapped instead of decoding the volume again in later runs, e.g. when evaluating new predictions
+            against the same GT. With `reorient`, the cached arrays are brought to the same voxel order after reading
+            them (see `align_masks`), so pairs with oblique directions are still reoriented in every run. The entries
+            are keyed by the path, size and modification time of the volume and the data type. Cannot be used with
+            `slab_size`. If `None`, the cache is not used. Default: `None`.
+        volume_cache_size (float): The maximum total size of the decoded volume cache, in GB. The least recently used
+            volumes are evicted first. Default: `10.0`.
+        shard (Union[Tuple[int, int], None]): An `(index, count)` pair. If given, only the cases `index`,
+            `index + count`, `index + 2 * count`, ... of the matched cases are evaluated, so that `count` shards, e.g.
+            running on different machines, evaluate each case once. The shard index starts at `0`. A shard without
+            cases, when `count` exceeds the number of matched cases, only writes the header of its `partial_path` file
+            and returns empty results without writing `output_path`. Default: `None`.
+        partial_path (Union[str, None]): If given, the voxel counts and Dice scores of each case are appended to this
+            JSON lines file as soon as the case is evaluated, so that the results are kept if the evaluation is
+            interrupted. The file can be merged with the partial results of the other shards using `merge_partials`.
+            Default: `None`.
+        resume (bool): If `True`, the cases already found in the `partial_path` file, e.g. written by an interrupted
+            evaluation, are not evaluated again and the remaining cases are appended to the file. Default: `False`.
+        surface_tolerance (Union[float, None]): If given, the 95th percentile Hausdorff distance (HD95) and the
+            normalized surface Dice (NSD) at this tolerance, in mm, are also computed for each label (see
+            `surface_metrics`), and their per-label means over the cases are added as the "HD95" and "NSD" rows of the
+            results. The distances use the voxel spacing of the GT. The result cache is not used for these metrics.
+            Cannot be used with `slab_size`. Default: `None`.
+        bootstrap (int): If positive, the number of bootstrap resamples of the cases used for computing confidence
+            intervals of the mean, weighted mean and Global Dice of each label and over the labels. The intervals are
+            computed from the voxel counts and Dice scores of each case, without reading the volumes again, and are
+            added as the "Mean CI low", "Mean CI high", "Weighted mean CI low", "Weighted mean CI high", "Global dice CI
+            low" and "Global dice CI high" rows of the results. The resamples use a fixed seed, so the intervals are
+            reproducible. Default: `0`.
+        confidence (float): The confidence level of the bootstrap confidence intervals. Default: `0.95`.
     """
+    assert prefetch >= 0, f'The number of prefetched pairs must not be negative, is {prefetch}.'
+    assert slab_size >= 0, f'The slab size must not be negative, is {slab_size}.'
+    assert slab_size == 0 or not reorient, 'Slab-wise evaluation does not support reorientation.'
+    assert slab_size == 0 or prefetch == 0, 'Slab-wise evaluation does not support prefetching.'
+    assert slab_size == 0 or volume_cache_dir is None, 'Slab-wise evaluation does not support the volume cache.'
+    assert slab_size == 0 or surface_tolerance is None, 'Slab-wise evaluation does not support surface metrics.'
+    assert surface_tolerance is None or surface_tolerance >= 0, \
+        f'The surface tolerance must not be negative, is {surface_tolerance}.'
+    assert not resume or partial_path is not None, 'Resuming requires a partial results file.'
+    assert bootstrap >= 0, f'The number of bootstrap resamples must not be negative, is {bootstrap}.'
+    assert 0 < confidence < 1, f'The confidence level must be between 0 and 1, is {confidence}.'
+    assert num_threads >= 0, f'The number of threads must not be negative, is {num_threads}.'
+    num_threads = thread_count(num_workers, num_threads)
+    assert engine in ENGINES, f'Engine must be one of {ENGINES}, is {engine}.'
     dtype = np.uint8 if dtype == 'uint8' else np.uint16
+    multiple = not isinstance(predictions, str)
+    if isinstance(predictions, dict):
+        models = dict(predictions)
+    elif multiple:
+        models = model_names(predictions)
+    else:
+        models = {None: predictions}
+    assert len(models) > 0, 'At least one prediction path is required.'
+
+    gt_files = None
+    pred_files = {}
+    for name, path in models.items():
+        model_gt_files, pred_files[name] = match_files(ground_truths, path, prefix, suffix, ignore_gt_size)
+        assert gt_files is None or model_gt_files == gt_files, \
+            f'The prediction files of {name} do not match the prediction files of the other models.'
+        gt_files = model_gt_files
+
+    if output_path is not None:
+        assert output_path.endswith('.csv') or output_path.endswith('.json'), (
+            f'If output path is not None, it must be either .csv or .json, is {output_path}')
+    assert all([isinstance(x, int) for x in indices.values()]), f'Indices must be integers, found {indices.values()}.'
+    assert len(gt_files) > 0, f'No cases found in {ground_truths}.'
+    num_cases = len(gt_files)
+    if shard is not None:
+        index, count = shard
+        assert 0 <= index < count, f'The shard index must be between 0 and the shard count {count}, is {index}.'
+        print(f"Evaluating shard {index}/{count} of {len(gt_files)} cases")
+        gt_files = gt_files[index::count]
+        pred_files = {name: files[index::count] for name, files in pred_files.items()}
+        if len(gt_files) == 0:
+            print(f"No cases in shard {index}/{count}, nothing to evaluate")
+            if partial_path is not None:
+                write_partial(partial_path, partial_header(indices, list(pred_files), reorient, dtype, tuple(shard),
+                                                           surface_tolerance, num_cases), [])
+            return {}
+    if multiple:
+        print(f"Found {len(gt_files)} cases, {len(models)} models and {len(indices)} classes")
+    else:
+        print(f"Found {len(gt_files)} cases and {len(indices)} classes")
+
+    profiles = None if profile_path is None else []
+    volume_cache = None if volume_cache_dir is None else VolumeCache(volume_cache_dir, volume_cache_size)
+    metrics = aggregate_metrics(gt_files, pred_files if multiple else pred_files[None], reorient, dtype, indices,
+                                num_workers, engine, cache_dir, cache_size, prefetch, slab_size, num_threads,
+                                volume_cache, profiles, partial_path, (0, 1) if shard is None else tuple(shard), resume,
+                                surface_tolerance, bootstrap, confidence, num_cases)
+    write_metrics(output_path, metrics, indices, console, multiple)
+    if profile_path is not None:
+        print(format_summary(write_profile(profile_path, profiles)))
+    return metrics
+
+
+def thread_count(num_workers: int, num_threads: int) -> int:
+    """ Limits the number of threads used by each process so that the processes and their threads do not oversubscribe
+    the CPUs. If `num_threads` is `0`, all the CPUs left available by the processes are used.
+    """
+    available = max((os.cpu_count() or 1) // max(num_workers, 1), 1)
+    if num_threads == 0:
+        return available
+    if num_threads > available:
+        print(f"Using {available} threads instead of {num_threads} to avoid oversubscribing the CPUs")
+        return available
+    return num_threads
+
+
+def model_names(predictions: Sequence[str]) -> Dict[str, str]:
+    """ Names each prediction path after its last component, falling back to the full paths when the names collide.
+    """
+    names = [os.path.basename(os.path.normpath(x)) for x in predictions]
+    if len(set(names)) < len(names):
+        names = list(predictions)
+    assert len(set(names)) == len(names), f'Duplicate prediction paths found: {predictions}.'
+    return dict(zip(names, predictions))
+
+
+def match_files(ground_truths: str, predictions: str, prefix: str, suffix: str, ignore_gt_size: bool) \
+        -> Tuple[List[str], List[str]]:
+    """ Matches the GT files with the prediction files, returning the paths of both.
+    """
     assert os.path.isfile(ground_truths) and os.path.isfile(predictions) or \
            os.path.isdir(ground_truths) and os.path.isdir(predictions), ('Prediction path and GT path must both be a '
                                                                          'single file or a folder.')
@@ -63,16 +238,7 @@ def dice_metrics(ground_truths: str, predictions: str, output_path: Union[str, N
     else:
         gt_files = [ground_truths]
         pred_files = [predictions]
-
-    if output_path is not None:
-        assert output_path.endswith('.csv') or output_path.endswith('.json'), (
-            f'If output path is not None, it must be either .csv or .json, is {output_path}')
-    assert all([isinstance(x, int) for x in indices.values()]), f'Indices must be integers, found {indices.values()}.'
-    print(f"Found {len(gt_files)} cases and {len(indices)} classes")
-
-    metrics = aggregate_metrics(gt_files, pred_files, reorient, dtype, indices, num_workers)
-    write_metrics(output_path, metrics, indices, console)
-    return metrics
+    return gt_files, pred_files
 
 
 def dice(x: ndarray, y: ndarray) -> Tuple[int, int, int, float]:
@@ -95,10 +261,205 @@ def dice(x: ndarray, y: ndarray) -> Tuple[int, int, int, float]:
     return common, both, x_sum, score
 
 
-def multi_class_dice(gt: ndarray, pred: ndarray, indices: Sequence[int]) -> Tuple[ndarray, ndarray, ndarray, ndarray]:
+def dice_from_counts(common_voxels: ndarray, all_voxels: ndarray) -> ndarray:
+    """ Calculates the Dice Score from the number of common voxels and the sum of GT and prediction voxels. The Dice
+    Score is 1.0 when both the GT and the prediction are empty.
+    """
+    common_voxels = np.asarray(common_voxels)
+    all_voxels = np.asarray(all_voxels)
+    scores = np.ones(all_voxels.shape, dtype=np.float64)
+    mask = all_voxels != 0
+    scores[mask] = 2 * common_voxels[mask] / all_voxels[mask]
+    return scores
+
+
+def compact_labels(x: ndarray, labels: ndarray) -> ndarray:
+    """ Maps each voxel to the position of its value in the sorted `labels`. Voxels with values not found in `labels`
+    are mapped to `len(labels)`.
+    """
+    n = len(labels)
+    out_dtype = np.min_scalar_type((n + 1) ** 2 - 1)  # Large enough for indexing the joint histogram
+    if x.dtype.kind == 'u' and x.dtype.itemsize <= 2:
+        # Lookup table over all the possible values
+        lut = np.full(np.iinfo(x.dtype).max + 1, n, dtype=out_dtype)
+        valid = (labels >= 0) & (labels < lut.size)
+        lut[labels[valid]] = np.flatnonzero(valid)
+        return lut[x]
+    ids = np.searchsorted(labels, x)
+    found = ids < n
+    found[found] = labels[ids[found]] == x[found]
+    ids[~found] = n
+    return ids.astype(out_dtype, copy=False)
+
+
+def histogram_counts(gt: ndarray, pred: ndarray, indices: Sequence[int]) -> Tuple[ndarray, ndarray, ndarray]:
+    """ Counts the common, GT and prediction voxels for all indices (labels) by reading each voxel once. The counts are
+    derived from a joint histogram of (GT, prediction) pairs, where all the labels not found in `indices` share a single
+    bin.
+    """
+    labels, inverse = np.unique(np.asarray(indices, dtype=np.int64), return_inverse=True)
+    n = len(labels) + 1
+    g = compact_labels(gt, labels)
+    p = compact_labels(pred, labels)
+    if n * n <= 2 ** 24:
+        histogram = np.bincount((g * n + p).ravel(), minlength=n * n).reshape(n, n)
+        common_voxels = histogram.diagonal()
+        gt_voxels = histogram.sum(axis=1)
+        pred_voxels = histogram.sum(axis=0)
+    else:
+        # The joint histogram would be too large, only the marginals and the diagonal are counted
+        g = g.ravel()
+        p = p.ravel()
+        common_voxels = np.bincount(g[g == p], minlength=n)
+        gt_voxels = np.bincount(g, minlength=n)
+        pred_voxels = np.bincount(p, minlength=n)
+    inverse = inverse.ravel()
+    return common_voxels[:-1][inverse], gt_voxels[:-1][inverse], pred_voxels[:-1][inverse]
+
+
+def bounding_boxes(x: ndarray, labels: ndarray) -> Tuple[ndarray, ndarray, ndarray]:
+    """ Counts the voxels and computes the bounding box of each of the sorted `labels`, using only the foreground
+    voxels. Returns the counts and the lower (inclusive) and upper (exclusive) corners of the bounding boxes.
+    """
+    n = len(labels)
+    if np.any(labels == 0):
+        ids = compact_labels(x, labels).ravel()
+        flat = np.flatnonzero(ids != n)
+        values = ids[flat]
+    else:
+        # Background voxels are skipped before mapping the labels
+        flat = np.flatnonzero(x)
+        values = compact_labels(x.ravel()[flat], labels)
+        flat = flat[values != n]
+        values = values[values != n]
+    counts = np.bincount(values, minlength=n)
+    lower = np.zeros((n, x.ndim), dtype=np.intp)
+    upper = np.zeros((n, x.ndim), dtype=np.intp)
+    present = np.flatnonzero(counts)
+    if len(present) > 0:
+        # Groups the foreground voxels by label, then reduces the coordinates of each group
+        order = np.argsort(values, kind='stable')
+        starts = (np.cumsum(counts) - counts)[present]
+        for axis, coords in enumerate(np.unravel_index(flat[order], x.shape)):
+            lower[present, axis] = np.minimum.reduceat(coords, starts)
+            upper[present, axis] = np.maximum.reduceat(coords, starts) + 1
+    return counts, lower, upper
+
+
+def bbox_counts(gt: ndarray, pred: ndarray, indices: Sequence[int]) -> Tuple[ndarray, ndarray, ndarray]:
+    """ Counts the common, GT and prediction voxels for all indices (labels) using the bounding boxes of each label.
+    The GT and prediction voxels are counted from the foreground voxels, while the common voxels are counted only in the
+    overlap of the GT and prediction bounding boxes. Labels missing from the GT or from the prediction are not scanned.
+    """
+    labels, inverse = np.unique(np.asarray(indices, dtype=np.int64), return_inverse=True)
+    gt_voxels, gt_lower, gt_upper = bounding_boxes(gt, labels)
+    pred_voxels, pred_lower, pred_upper = bounding_boxes(pred, labels)
+
+    common_voxels = np.zeros(len(labels), dtype=np.int64)
+    for i in np.flatnonzero((gt_voxels > 0) & (pred_voxels > 0)):
+        lower = np.maximum(gt_lower[i], pred_lower[i])
+        upper = np.minimum(gt_upper[i], pred_upper[i])
+        if np.any(lower >= upper):
+            continue
+        box = tuple(slice(a, b) for a, b in zip(lower, upper))
+        common_voxels[i] = np.count_nonzero((gt[box] == labels[i]) & (pred[box] == labels[i]))
+    inverse = inverse.ravel()
+    return common_voxels[inverse], gt_voxels[inverse], pred_voxels[inverse]
+
+
+def surface_voxels(mask: ndarray) -> ndarray:
+    """ Returns the surface of a boolean mask: the voxels of the mask with at least one of their 6-connected neighbours
+    outside the mask. Voxels on the border of the array are part of the surface.
+    """
+    interior = mask.copy()
+    for axis in range(mask.ndim):
+        front = tuple(slice(1, None) if i == axis else slice(None) for i in range(mask.ndim))
+        back = tuple(slice(None, -1) if i == axis else slice(None) for i in range(mask.ndim))
+        interior[front] &= mask[back]
+        interior[back] &= mask[front]
+        interior[tuple(0 if i == axis else slice(None) for i in range(mask.ndim))] = False
+        interior[tuple(-1 if i == axis else slice(None) for i in range(mask.ndim))] = False
+    return mask & ~interior
+
+
+def distance_to_surface(surface: ndarray, spacing: Sequence[float]) -> ndarray:
+    """ Computes the Euclidean distance, in mm, from each voxel to the nearest voxel of `surface` using the Maurer
+    distance transform of SimpleITK. `spacing` is in ndarray (z, y, x) order.
+    """
+    img = sitk.GetImageFromArray(surface.astype(np.uint8))
+    img.SetSpacing(tuple(float(x) for x in reversed(spacing)))
+    distances = sitk.SignedMaurerDistanceMap(img, insideIsPositive=False, squaredDistance=False, useImageSpacing=True)
+    # The surface voxels have a non-positive signed distance
+    return np.maximum(sitk.GetArrayViewFromImage(distances), 0)
+
+
+def surface_metrics(gt: ndarray, pred: ndarray, indices: Sequence[int], spacing: Sequence[float],
+                    tolerance: float) -> Tuple[ndarray, ndarray]:
+    """ Calculates the 95th percentile Hausdorff distance (HD95), in mm, and the normalized surface Dice (NSD) at
+    `tolerance` mm for a pair of prediction and GT using all indices (labels). The surface of a label is made of its
+    voxels with a 6-connected neighbour outside the label (see `surface_voxels`), and the distances between the
+    surfaces are only computed in the union of the GT and prediction bounding boxes of the label, padded by one voxel.
+    HD95 is the largest of the 95th percentiles of the distances from the GT surface to the prediction surface and back,
+    while NSD is the fraction of the voxels of both surfaces lying within `tolerance` of the other surface. A label
+    missing from both the GT and the prediction has an HD95 of 0 and an NSD of 1, while a label missing from only one of
+    them has an undefined (NaN) HD95 and an NSD of 0. `spacing` is the voxel spacing in ndarray (z, y, x) order.
+    """
+    assert gt.shape == pred.shape, f'GT and prediction have different shapes: {gt.shape} and {pred.shape}.'
+    labels, inverse = np.unique(np.asarray(indices, dtype=np.int64), return_inverse=True)
+    gt_voxels, gt_lower, gt_upper = bounding_boxes(gt, labels)
+    pred_voxels, pred_lower, pred_upper = bounding_boxes(pred, labels)
+
+    hd95 = np.full(len(labels), np.nan)
+    nsd = np.zeros(len(labels))
+    for i, label in enumerate(labels):
+        if gt_voxels[i] == 0 or pred_voxels[i] == 0:
+            if gt_voxels[i] == pred_voxels[i]:
+                hd95[i], nsd[i] = 0.0, 1.0
+            continue
+        lower = np.maximum(np.minimum(gt_lower[i], pred_lower[i]) - 1, 0)
+        upper = np.minimum(np.maximum(gt_upper[i], pred_upper[i]) + 1, gt.shape)
+        box = tuple(slice(a, b) for a, b in zip(lower, upper))
+        gt_surface = surface_voxels(gt[box] == label)
+        pred_surface = surface_voxels(pred[box] == label)
+        gt_to_pred = distance_to_surface(pred_surface, spacing)[gt_surface]
+        pred_to_gt = distance_to_surface(gt_surface, spacing)[pred_surface]
+        hd95[i] = max(np.percentile(gt_to_pred, 95), np.percentile(pred_to_gt, 95))
+        nsd[i] = (np.count_nonzero(gt_to_pred <= tolerance) + np.count_nonzero(pred_to_gt <= tolerance)) / \
+            (len(gt_to_pred) + len(pred_to_gt))
+    inverse = inverse.ravel()
+    return hd95[inverse], nsd[inverse]
+
+
+def threaded_multi_class_dice(gt: ndarray, pred: ndarray, indices: Sequence[int], engine: str, num_threads: int) \
+        -> Tuple[ndarray, ndarray, ndarray, ndarray]:
+    """ Splits the volumes into chunks along the first axis, calculates the voxel counts of each chunk in a thread pool
+    and sums them. NumPy releases the GIL during the reductions, so the chunks are processed in parallel.
+    """
+    chunks = min(num_threads, len(gt))
+    with ThreadPoolExecutor(max_workers=chunks) as executor:
+        scores = list(executor.map(lambda x, y: multi_class_dice(x, y, indices, engine),
+                                   np.array_split(gt, chunks), np.array_split(pred, chunks)))
+    common_voxels = np.sum([x[0] for x in scores], axis=0)
+    all_voxels = np.sum([x[1] for x in scores], axis=0)
+    gt_voxels = np.sum([x[2] for x in scores], axis=0)
+    return common_voxels, all_voxels, gt_voxels, dice_from_counts(common_voxels, all_voxels)
+
+
+def multi_class_dice(gt: ndarray, pred: ndarray, indices: Sequence[int], engine: str = 'loop', num_threads: int = 1) \
+        -> Tuple[ndarray, ndarray, ndarray, ndarray]:
     """ Calculates the Dice Score and collects common, GT and the union of voxels for a pair of prediction and GT
-    using all indices (labels).
+    using all indices (labels). If `num_threads` is greater than 1, the volumes are split into chunks which are
+    evaluated in parallel threads.
     """
+    assert gt.shape == pred.shape, f'GT and prediction have different shapes: {gt.shape} and {pred.shape}.'
+    if num_threads > 1 and len(gt) > 1:
+        return threaded_multi_class_dice(gt, pred, indices, engine, num_threads)
+    if engine in ('histogram', 'bbox'):
+        counts = histogram_counts if engine == 'histogram' else bbox_counts
+        common_voxels, gt_voxels, pred_voxels = counts(gt, pred, indices)
+        all_voxels = gt_voxels + pred_voxels
+        return common_voxels, all_voxels, gt_voxels, dice_from_counts(common_voxels, all_voxels)
+
     common_voxels = []
     all_voxels = []
     gt_voxels = []
@@ -117,59 +478,294 @@ def multi_class_dice(gt: ndarray, pred: ndarray, indices: Sequence[int]) -> Tupl
     return common_voxels, all_voxels, gt_voxels, dice_scores
 
 
-def evaluate_prediction(gt: str, pred: str, reorient: bool, dtype: np.dtype, indices: Sequence[int]) \
-        -> Tuple[ndarray, ndarray, ndarray, ndarray]:
-    """ Evaluates a single pair of prediction and GT and collects metrics.
+def score_pair(gt: ndarray, pred: ndarray, indices: Sequence[int], engine: str = 'loop', num_threads: int = 1,
+               spacing: Union[Sequence[float], None] = None, surface_tolerance: Union[float, None] = None) -> tuple:
+    """ Calculates the metrics of a pair of prediction and GT (see `multi_class_dice`), followed by their HD95 and NSD
+    (see `surface_metrics`) when `surface_tolerance` is given. `spacing` is the voxel spacing in ndarray (z, y, x)
+    order.
+    """
+    scores = multi_class_dice(gt, pred, indices, engine, num_threads)
+    if surface_tolerance is None:
+        return scores
+    return (*scores, *surface_metrics(gt, pred, indices, spacing, surface_tolerance))
+
+
+def evaluate_case_slabs(gt: str, preds: Sequence[str], dtype: np.dtype, indices: Sequence[int], engine: str,
+                        slab_size: int, num_threads: int = 1, stats: Union[dict, None] = None) \
+        -> List[Tuple[ndarray, ndarray, ndarray, ndarray]]:
+    """ Evaluates several predictions against the same GT slab by slab, summing the voxel counts of each slab, so only
+    one slab of each volume is kept in memory. When profiling, the casting of each slab is included in the read stage.
+    """
+    size = read_header(gt)['size']
+    for pred in preds:
+        pred_size = read_header(pred)['size']
+        assert pred_size == size, f'GT {gt} and prediction {pred} have different sizes: {size} and {pred_size}.'
+
+    counts = [[0, 0, 0] for _ in preds]
+    slabs = zip(read_slabs(gt, dtype, slab_size), *[read_slabs(pred, dtype, slab_size) for pred in preds])
+    while True:
+        with timed(stats, 'read'):
+            group = next(slabs, None)
+        if group is None:
+            break
+        gt_slab, *pred_slabs = group
+        if stats is not None:
+            stats['array_bytes'] = stats.get('array_bytes', 0) + sum(x.nbytes for x in group)
+            track_array_bytes(stats, sum(x.nbytes for x in group))
+        for pred_counts, pred_slab in zip(counts, pred_slabs):
+            with timed(stats, 'score'):
+                common_voxels, all_voxels, gt_voxels, _ = multi_class_dice(gt_slab, pred_slab, indices, engine,
+                                                                           num_threads)
+            pred_counts[0] = pred_counts[0] + common_voxels
+            pred_counts[1] = pred_counts[1] + all_voxels
+            pred_counts[2] = pred_counts[2] + gt_voxels
+    if stats is not None:
+        stats['bytes_read'] = stats.get('bytes_read', 0) + sum(os.path.getsize(x) for x in (gt, *preds))
+    return [(common_voxels, all_voxels, gt_voxels, dice_from_counts(common_voxels, all_voxels))
+            for common_voxels, all_voxels, gt_voxels in counts]
+
+
+def evaluate_case(gt: str, preds: Sequence[str], reorient: bool, dtype: np.dtype, indices: Sequence[int],
+                  engine: str = 'loop', slab_size: int = 0, num_threads: int = 1,
+                  volume_cache: Union[VolumeCache, None] = None, surface_tolerance: Union[float, None] = None,
+                  stats: Union[dict, None] = None) -> List[tuple]:
+    """ Evaluates several predictions against the same GT, reading the GT only once, and collects metrics for each
+    prediction. If `slab_size` is positive, the volumes are read and evaluated slab by slab. Each volume (or slab) is
+    evaluated using `num_threads` threads. The decoded volumes are memory-mapped from `volume_cache` when given. With
+    `reorient`, each prediction is brought to the voxel order of the GT (see `align_masks`). The HD95 and NSD are also
+    computed when `surface_tolerance` is given (see `score_pair`). If `stats` is given, the time spent in each stage,
+    the number of bytes read and decoded and the peak array memory are added to it.
+    """
+    if slab_size > 0:
+        assert not reorient, 'Slab-wise evaluation does not support reorientation.'
+        assert volume_cache is None, 'Slab-wise evaluation does not support the volume cache.'
+        assert surface_tolerance is None, 'Slab-wise evaluation does not support surface metrics.'
+        return evaluate_case_slabs(gt, preds, dtype, indices, engine, slab_size, num_threads, stats)
+    gt = read_volume(gt, False, dtype, stats, volume_cache)
+    ret = []
+    for pred in preds:
+        pred = read_volume(pred, False, dtype, stats, volume_cache)
+        gt_mask, pred_mask = align_masks(gt, pred, stats) if reorient else (gt[0], pred[0])
+        with timed(stats, 'score'):
+            ret.append(score_pair(gt_mask, pred_mask, indices, engine, num_threads,
+                                  aligned_spacing(gt[1], pred[1], reorient), surface_tolerance))
+        if stats is not None:
+            stats['live_array_bytes'] -= pred[0].nbytes
+    return ret
+
+
+def evaluate_prediction(gt: str, pred: str, reorient: bool, dtype: np.dtype, indices: Sequence[int],
+                        engine: str = 'loop', slab_size: int = 0, num_threads: int = 1,
+                        volume_cache: Union[VolumeCache, None] = None, surface_tolerance: Union[float, None] = None,
+                        stats: Union[dict, None] = None) -> tuple:
+    """ Evaluates a single pair of prediction and GT and collects metrics, including the HD95 and NSD when
+    `surface_tolerance` is given. If `stats` is given, the time spent in each stage, the number of bytes read and
+    decoded and the peak array memory are added to it.
+    """
+    return evaluate_case(gt, [pred], reorient, dtype, indices, engine, slab_size, num_threads, volume_cache,
+                         surface_tolerance, stats)[0]
+
+
+def finish_profile(stats: dict, total: Union[float, None] = None) -> dict:
+    """ Sets the total time of a case profile, which defaults to the sum of the time spent in each stage.
     """
-    gt = read_mask(gt, reorient, dtype)
-    pred = read_mask(pred, reorient, dtype)
-    return multi_class_dice(gt, pred, indices)
+    stats.pop('live_array_bytes', None)
+    stats['total'] = sum(stats.get(stage, 0.0) for stage in STAGES) if total is None else total
+    return stats
 
 
-def evaluate_prediction_wrapper(data) -> Tuple[ndarray, ndarray, ndarray, ndarray]:
-    """ Wrapper for `evaluate_prediction` for calling it in parallel processes
+def evaluate_case_wrapper(data) -> Tuple[List[Tuple[ndarray, ndarray, ndarray, ndarray]], Union[dict, None]]:
+    """ Wrapper for `evaluate_case` for calling it in parallel processes. Also returns the case profile when profiling.
     """
-    gt, pred, reorient, dtype, indices = data
-    return evaluate_prediction(gt, pred, reorient, dtype, indices)
+    gt, preds, reorient, dtype, indices, engine, slab_size, num_threads, volume_cache, surface_tolerance, profile = data
+    if not profile:
+        return evaluate_case(gt, preds, reorient, dtype, indices, engine, slab_size, num_threads, volume_cache,
+                             surface_tolerance), None
+    stats = {'case': gt}
+    start = time.perf_counter()
+    scores = evaluate_case(gt, preds, reorient, dtype, indices, engine, slab_size, num_threads, volume_cache,
+                           surface_tolerance, stats)
+    return scores, finish_profile(stats, time.perf_counter() - start)
 
 
-def execute_evaluate_predictions(gt_files: List[str], pred_files: List[str], reorient: bool, dtype: np.dtype,
-                                 indices: Sequence[int], num_workers: int) \
-        -> Sequence[Tuple[ndarray, ndarray, ndarray, ndarray]]:
-    """ Execute the prediction evaluation sequentially or in parallel.
+def execute_evaluate_predictions(gt_files: List[str], pred_files: List[Sequence[str]], reorient: bool,
+                                 dtype: np.dtype, indices: Sequence[int], num_workers: int, engine: str = 'loop',
+                                 prefetch: int = 0, slab_size: int = 0, num_threads: int = 1,
+                                 volume_cache: Union[VolumeCache, None] = None,
+                                 profiles: Union[List[dict], None] = None,
+                                 callback: Union[Callable[[int, list], None], None] = None,
+                                 surface_tolerance: Union[float, None] = None) -> List[List[tuple]]:
+    """ Execute the prediction evaluation sequentially or in parallel. Each GT is evaluated against all its predictions
+    (one for each model). The headers of all the volumes are checked first (see `preflight`). When evaluating
+    sequentially with `prefetch`, the volumes are read by background threads while the current case is scored. When
+    evaluating in parallel, the largest cases are scheduled first and each idle process takes the next case, so that a
+    large case does not leave the other processes idle at the end. If `profiles` is given, the profile of each case is
+    appended to it. If `callback` is given, it is called with the position and the metrics of each case as soon as the
+    case is evaluated, i.e. in the completion order when evaluating in parallel.
     """
+    case_voxels = preflight(gt_files, pred_files, reorient)
+    if num_workers == 0 and prefetch > 0:
+        stats = None if profiles is None else []
+        ret = []
+        for pairs in tqdm(prefetch_masks([(gt, *preds) for gt, preds in zip(gt_files, pred_files)], reorient, dtype,
+                                         prefetch, stats, volume_cache), total=len(gt_files)):
+            with timed(None if stats is None else stats[-1], 'score'):
+                ret.append([score_pair(gt, pred, indices, engine, num_threads, spacing, surface_tolerance)
+                            for gt, pred, spacing in pairs])
+            if callback is not None:
+                callback(len(ret) - 1, ret[-1])
+        if profiles is not None:
+            profiles.extend(finish_profile(x) for x in stats)
+        return ret
+
+    tasks = [(gt, preds, reorient, dtype, indices, engine, slab_size, num_threads, volume_cache, surface_tolerance,
+              profiles is not None) for gt, preds in zip(gt_files, pred_files)]
     if num_workers == 0:
-        ret = [evaluate_prediction(gt, pred, reorient, dtype, indices) for gt, pred in tqdm(
-            list(zip(gt_files, pred_files)))]
+        ret = collect_cases(enumerate(map(evaluate_case_wrapper, tasks)), len(tasks), callback)
     else:
-        chunksize = max(len(gt_files) // 50 // num_workers, 1)  # 50 is arbitrarily chosen
-        # TODO: Let the user choose the chunksize
-        ret = process_map(evaluate_prediction_wrapper,
-                          [(gt, pred, reorient, dtype, indices) for gt, pred in zip(gt_files, pred_files)],
-                          max_workers=num_workers, chunksize=chunksize)
+        order = sorted(range(len(tasks)), key=lambda i: case_voxels[i], reverse=True)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(evaluate_case_wrapper, tasks[i]): i for i in order}
+            ret = collect_cases(((futures[x], x.result()) for x in as_completed(futures)), len(tasks), callback)
+    if profiles is not None:
+        profiles.extend(stats for _, stats in ret)
+    return [scores for scores, _ in ret]
+
+
+def preflight(gt_files: List[str], pred_files: List[Sequence[str]], reorient: bool, num_threads: int = 8) -> List[int]:
+    """ Reads only the headers of each GT and its predictions, failing before any volume is decoded when the size of a
+    prediction does not match the size of its GT, and warning when their spacings differ. With `reorient`, the sizes
+    are compared in the same axis order, unless a direction is oblique. Returns the number of voxels read for each case,
+    which is used for scheduling the largest cases first.
+    """
+    paths = list(dict.fromkeys(x for gt, preds in zip(gt_files, pred_files) for x in (gt, *preds)))
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        headers = dict(zip(paths, executor.map(read_header, paths)))
+
+    case_voxels = []
+    mismatches = []
+    spacings = []
+    for gt, preds in zip(gt_files, pred_files):
+        reference = headers[gt]
+        for pred in preds:
+            header = headers[pred]
+            size, spacing = header['size'], header['spacing']
+            if reorient:
+                size = align_axes(size, header['direction'], reference['direction'])
+                spacing = align_axes(spacing, header['direction'], reference['direction'])
+            if size is not None and tuple(size) != tuple(reference['size']):
+                mismatches.append(f"{pred} has size {tuple(size)} instead of {tuple(reference['size'])}")
+            elif spacing is not None and not np.allclose(spacing, reference['spacing'], rtol=1e-5, atol=0):
+                spacings.append(pred)
+        case_voxels.append(int(np.prod(reference['size'])) * (1 + len(preds)))
+    assert len(mismatches) == 0, f'The size of {len(mismatches)} predictions does not match the size of their GT: ' + \
+                                 '; '.join(mismatches[:10])
+    if len(spacings) > 0:
+        print(f"Warning: the spacing of {len(spacings)} predictions differs from the spacing of their GT, "
+              f"e.g. {spacings[0]}")
+    return case_voxels
+
+
+def collect_cases(results: Iterable[Tuple[int, Tuple[list, Union[dict, None]]]], total: int,
+                  callback: Union[Callable[[int, list], None], None] = None) -> List[Tuple[list, Union[dict, None]]]:
+    """ Collects the results of `evaluate_case_wrapper`, given in any order together with the position of their case,
+    while showing the progress, calling `callback` with the position and the metrics of each case as soon as it is
+    available. Returns the results in the order of the cases.
+    """
+    ret = [None] * total
+    for i, (scores, stats) in tqdm(results, total=total):
+        ret[i] = (scores, stats)
+        if callback is not None:
+            callback(i, scores)
     return ret
 
 
-def evaluate_predictions(gt_files: List[str], pred_files: List[str], reorient: bool, dtype: np.dtype,
-                         indices: Sequence[int], num_workers: int) -> Tuple[ndarray, ndarray, ndarray, ndarray]:
-    """ Evaluates each pair of prediction and GT and collects metrics.
+def cached_evaluate_predictions(gt_files: List[str], pred_files: List[Sequence[str]], reorient: bool,
+                                dtype: np.dtype, indices: Sequence[int], num_workers: int, engine: str,
+                                cache_dir: str, cache_size: int, prefetch: int, slab_size: int, num_threads: int,
+                                volume_cache: Union[VolumeCache, None] = None,
+                                profiles: Union[List[dict], None] = None,
+                                callback: Union[Callable[[int, list], None], None] = None) \
+        -> List[List[Tuple[ndarray, ndarray, ndarray, ndarray]]]:
+    """ Evaluates only the pairs of prediction and GT which are not found in the result cache, storing their voxel
+    counts in the cache as soon as each case is evaluated. A GT is not read when all its predictions are cached.
     """
-    scores = execute_evaluate_predictions(gt_files, pred_files, reorient, dtype, indices, num_workers)
-    common_voxels = []
-    all_voxels = []
-    gt_voxels = []
-    dice_scores = []
-    for a, b, c, d in scores:
-        common_voxels.append(a)
-        all_voxels.append(b)
-        gt_voxels.append(c)
-        dice_scores.append(d)
+    cache = ResultCache(cache_dir, cache_size)
+    keys = [[cache.key(gt, pred, reorient, dtype, indices) for pred in preds]
+            for gt, preds in zip(gt_files, pred_files)]
+    ret = []
+    for case_keys in keys:
+        ret.append([])
+        for key in case_keys:
+            counts = cache.get(key)
+            ret[-1].append(None if counts is None else (*counts, dice_from_counts(counts[0], counts[1])))
+    missing = [[j for j, x in enumerate(case) if x is None] for case in ret]
+    todo = [i for i, x in enumerate(missing) if len(x) > 0]
+    print(f"Found {sum(map(len, keys)) - sum(map(len, missing))} cached results")
+    if callback is not None:
+        for i, case in enumerate(missing):
+            if len(case) == 0:
+                callback(i, ret[i])
 
-    common_voxels = np.array(common_voxels)
-    all_voxels = np.array(all_voxels)
-    gt_voxels = np.array(gt_voxels)
-    dice_scores = np.array(dice_scores)
-    return common_voxels, all_voxels, gt_voxels, dice_scores
+    def case_done(k: int, case_scores: list):
+        i = todo[k]
+        for j, score in zip(missing[i], case_scores):
+            cache.put(keys[i][j], *score[:3])
+            ret[i][j] = score
+        if callback is not None:
+            callback(i, ret[i])
+
+    if len(todo) > 0:
+        execute_evaluate_predictions([gt_files[i] for i in todo],
+                                     [[pred_files[i][j] for j in missing[i]] for i in todo], reorient, dtype, indices,
+                                     num_workers, engine, prefetch, slab_size, num_threads, volume_cache, profiles,
+                                     case_done)
+        cache.evict()
+    return ret
+
+
+def stack_scores(scores: Sequence[tuple]) -> Tuple[ndarray, ...]:
+    """ Stacks the metrics collected for each case: the common, both and GT voxel counts and the Dice scores,
+    followed by the HD95 and NSD when they were computed.
+    """
+    return tuple(np.array(x) for x in zip(*scores))
+
+
+def evaluate_predictions(gt_files: List[str], pred_files: List[Sequence[str]], reorient: bool, dtype: np.dtype,
+                         indices: Sequence[int], num_workers: int, engine: str = 'loop',
+                         cache_dir: Union[str, None] = None, cache_size: int = 100000, prefetch: int = 0,
+                         slab_size: int = 0, num_threads: int = 1, volume_cache: Union[VolumeCache, None] = None,
+                         profiles: Union[List[dict], None] = None,
+                         callback: Union[Callable[[int, list], None], None] = None,
+                         results: Union[Dict[int, list], None] = None,
+                         surface_tolerance: Union[float, None] = None) -> List[Tuple[ndarray, ...]]:
+    """ Evaluates each GT against all its predictions (one for each model) and collects metrics for each model. The
+    cases whose metrics are found in `results`, which maps case positions to metrics, are not evaluated again. If
+    `callback` is given, it is called with the position and the metrics of each evaluated case as soon as it is done.
+    The result cache only holds voxel counts, so it is not used when `surface_tolerance` is given.
+    """
+    results = {} if results is None else results
+    todo = [i for i in range(len(gt_files)) if i not in results]
+
+    def case_done(k: int, case_scores: list):
+        if callback is not None:
+            callback(todo[k], case_scores)
+
+    scores = []
+    if len(todo) > 0:
+        todo_gt_files = [gt_files[i] for i in todo]
+        todo_pred_files = [pred_files[i] for i in todo]
+        if cache_dir is None or surface_tolerance is not None:
+            scores = execute_evaluate_predictions(todo_gt_files, todo_pred_files, reorient, dtype, indices, num_workers,
+                                                  engine, prefetch, slab_size, num_threads, volume_cache, profiles,
+                                                  case_done, surface_tolerance)
+        else:
+            scores = cached_evaluate_predictions(todo_gt_files, todo_pred_files, reorient, dtype, indices, num_workers,
+                                                 engine, cache_dir, cache_size, prefetch, slab_size, num_threads,
+                                                 volume_cache, profiles, case_done)
+    results = {**results, **dict(zip(todo, scores))}
+    scores = [results[i] for i in range(len(gt_files))]
+    return [stack_scores([case[i] for case in scores]) for i in range(len(pred_files[0]))]
 
 
 def average(x: Union[ndarray, Sequence], axis: int = None, weights: ndarray = None) -> ndarray:
@@ -178,16 +774,157 @@ def average(x: Union[ndarray, Sequence], axis: int = None, weights: ndarray = No
     return np.average(x, axis=axis, weights=weights)
 
 
-def aggregate_metrics(gt_files: List[str], pred_files: List[str], reorient: bool, dtype: np.dtype,
-                      indices: dict, num_workers: int) -> dict:
+def nan_average(x: Union[ndarray, Sequence], weights: ndarray = None) -> float:
+    """ Averages the values of `x` which are not NaN (see `average`), returning NaN if all the values are NaN.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    valid = ~np.isnan(x)
+    if not np.any(valid):
+        return np.nan
+    return average(x[valid], weights=None if weights is None else np.asarray(weights)[valid])
+
+
+def aggregate_metrics(gt_files: List[str], pred_files: Union[List[str], Dict[str, List[str]]], reorient: bool,
+                      dtype: np.dtype, indices: dict, num_workers: int, engine: str = 'loop',
+                      cache_dir: Union[str, None] = None, cache_size: int = 100000, prefetch: int = 0,
+                      slab_size: int = 0, num_threads: int = 1, volume_cache: Union[VolumeCache, None] = None,
+                      profiles: Union[List[dict], None] = None, partial_path: Union[str, None] = None,
+                      shard: Tuple[int, int] = (0, 1), resume: bool = False,
+                      surface_tolerance: Union[float, None] = None, bootstrap: int = 0,
+                      confidence: float = 0.95, num_cases: Union[int, None] = None) -> dict:
     """ Evaluates and aggregates metrics from each pair of prediction and GT, calculating the Dice Score for each label,
     the mean and weighted mean for each case and also the per-label mean, weighted mean and Global Dice. The Union Dice
-    is calculated as if all volumes are combined into one single volume.
+    is calculated as if all volumes are combined into one single volume. When `pred_files` maps model names to
+    prediction files, each GT is read once and the metrics of each model are returned. If `profiles` is given, the
+    profile of each evaluated case is appended to it. If `partial_path` is given, the voxel counts of each case are
+    also appended to a partial results file as soon as the case is evaluated, `shard` describing which of the
+    `num_cases` matched cases were given (all of them by default). With `resume`, the cases already found in the
+    partial results file are not evaluated again. If `surface_tolerance` is given, the per-label means of the HD95 and
+    NSD are also returned, and if `bootstrap` is positive, the bootstrap confidence intervals as well (see
+    `summarize_metrics`).
+    """
+    models = pred_files if isinstance(pred_files, dict) else {None: pred_files}
+    case_preds = list(zip(*models.values()))
+    if partial_path is None:
+        scores = evaluate_predictions(gt_files, case_preds, reorient, dtype, tuple(indices.values()), num_workers,
+                                      engine, cache_dir, cache_size, prefetch, slab_size, num_threads, volume_cache,
+                                      profiles, surface_tolerance=surface_tolerance)
+    else:
+        index, count = shard
+        num_cases = len(gt_files) if num_cases is None else num_cases
+        header = partial_header(indices, list(models), reorient, dtype, shard, surface_tolerance, num_cases)
+        records = resume_records(partial_path, header, gt_files, case_preds) if resume else {}
+        results = {i: [(*x, dice_from_counts(x[0], x[1]), *y)
+                       for x, y in zip(record_counts(record), record_surface_metrics(record))]
+                   for i, record in records.items()}
+        write_partial(partial_path, header, list(records.values()))
+        with open(partial_path, 'a') as f:
+            def log_case(i: int, case_scores: list):
+                append_record(f, case_record(index + i * count, gt_files[i], case_preds[i], case_scores))
+
+            scores = evaluate_predictions(gt_files, case_preds, reorient, dtype, tuple(indices.values()), num_workers,
+                                          engine, cache_dir, cache_size, prefetch, slab_size, num_threads,
+                                          volume_cache, profiles, log_case, results, surface_tolerance)
+    metrics = {name: summarize_metrics(files, *model_scores[:4], indices, *model_scores[4:], bootstrap=bootstrap,
+                                       confidence=confidence)
+               for (name, files), model_scores in zip(models.items(), scores)}
+    return metrics if isinstance(pred_files, dict) else metrics[None]
+
+
+def resume_records(partial_path: str, header: dict, gt_files: List[str], pred_files: List[Sequence[str]]) \
+        -> Dict[int, dict]:
+    """ Reads the case records of an interrupted evaluation from its partial results file, returning them by position
+    in `gt_files`. Returns no records if the file does not exist.
+    """
+    if not os.path.isfile(partial_path):
+        return {}
+    partial, records = read_partial(partial_path)
+    assert partial == header, f'{partial_path} was written by a different evaluation: {partial}.'
+    index, count = header['shard']
+    ret = {}
+    for record in records:
+        i = (record['index'] - index) // count
+        matches = 0 <= i < len(gt_files) and record['case'] == gt_files[i] and \
+            record['predictions'] == list(pred_files[i])
+        assert matches, f"Case {record['case']} of {partial_path} does not match the evaluated files."
+        ret[i] = record
+    print(f"Resuming from {len(ret)} evaluated cases")
+    return ret
+
+
+def merge_partials(partial_paths: Sequence[str], output_path: Union[str, None], console: bool = False,
+                   bootstrap: int = 0, confidence: float = 0.95) -> dict:
+    """ Merges the partial results written by the shards of an evaluation, writing the aggregated results in a csv or
+    json file and returning them as a `dict`, exactly as if all the cases were evaluated by a single `dice_metrics`
+    call.
+
+    Args:
+        partial_paths (Sequence[str]): The paths to the partial results files, written using `partial_path`.
+        output_path (Union[str, None]): The output path to write the merged metrics. Can be a csv or json file,
+            depending on extension. If `None`, the metrics will not be written to a file.
+        console (bool): If `True`, also prints the Dice metrics to console. Default: `False`.
+        bootstrap (int): If positive, the number of bootstrap resamples of the merged cases used for computing
+            confidence intervals (see `dice_metrics`). Default: `0`.
+        confidence (float): The confidence level of the bootstrap confidence intervals. Default: `0.95`.
+    """
+    assert len(partial_paths) > 0, 'At least one partial results file is required.'
+    if output_path is not None:
+        assert output_path.endswith('.csv') or output_path.endswith('.json'), (
+            f'If output path is not None, it must be either .csv or .json, is {output_path}')
+    header = None
+    shards = set()
+    records = {}
+    for path in partial_paths:
+        partial, partial_records = read_partial(path)
+        shard = tuple(partial.pop('shard'))
+        assert header is None or partial == header, f'{path} was written by a different evaluation: {partial}.'
+        assert shard not in shards and all(x[1] == shard[1] for x in shards), \
+            f'{path} has shard {shard[0]}/{shard[1]}, which does not match the other shards: {sorted(shards)}.'
+        header = partial
+        shards.add(shard)
+        for record in partial_records:
+            assert record['index'] not in records, f"Case {record['case']} is found in several partial results files."
+            records[record['index']] = record
+    count = shard[1]
+    missing = sorted(set(range(count)) - {x[0] for x in shards})
+    missing_cases = [] if 'cases' not in header else sorted(set(range(header['cases'])) - set(records))
+    if len(missing_cases) > 0:
+        incomplete = sorted({i % count for i in missing_cases} - set(missing))
+        print(f"Warning: {len(missing_cases)} of the {header['cases']} cases are missing, the merged metrics only "
+              f"cover {len(records)} cases. Missing shards: {missing}, incomplete (e.g. interrupted) shards: "
+              f"{incomplete} of {count}")
+    elif len(missing) > 0:
+        print(f"Missing shards {missing} of {count}, merging {len(records)} cases")
+
+    records = [records[i] for i in sorted(records)]
+    assert len(records) > 0, 'No cases found in the partial results files.'
+    indices = header['indices']
+    metrics = {}
+    for i, name in enumerate(header['models']):
+        common_voxels = np.array([x['common_voxels'][i] for x in records])
+        all_voxels = np.array([x['all_voxels'][i] for x in records])
+        gt_voxels = np.array([x['gt_voxels'][i] for x in records])
+        surface = [np.array([record_surface_metrics(x)[i][j] for x in records]) for j in range(2)] \
+            if 'surface_tolerance' in header else []
+        metrics[name] = summarize_metrics([x['predictions'][i] for x in records], common_voxels, all_voxels, gt_voxels,
+                                          dice_from_counts(common_voxels, all_voxels), indices, *surface,
+                                          bootstrap=bootstrap, confidence=confidence)
+    multiple = header['models'] != [None]
+    metrics = metrics if multiple else metrics[None]
+    write_metrics(output_path, metrics, indices, console, multiple)
+    return metrics
+
+
+def summarize_metrics(pred_files: List[str], common_voxels: ndarray, all_voxels: ndarray, gt_voxels: ndarray,
+                      dice_scores: ndarray, indices: dict, hd95: Union[ndarray, None] = None,
+                      nsd: Union[ndarray, None] = None, bootstrap: int = 0, confidence: float = 0.95) -> dict:
+    """ Aggregates the metrics collected for each case, calculating the mean and weighted mean for each case and also
+    the per-label mean, weighted mean and Global Dice. When the HD95 and NSD of each case are given, their per-label
+    means over the cases are added as the "HD95" and "NSD" rows, ignoring the undefined (NaN) HD95 of the labels
+    missing from only the GT or the prediction. If `bootstrap` is positive, the bootstrap confidence intervals of the
+    mean, weighted mean and Global Dice are also added (see `bootstrap_metrics`).
     """
     index_keys = indices.keys()
-    index_values = indices.values()
-    common_voxels, all_voxels, gt_voxels, dice_scores = evaluate_predictions(
-        gt_files, pred_files, reorient, dtype, tuple(index_values), num_workers)
     metrics = {}
     for pred, scores, voxels in zip(pred_files, dice_scores, gt_voxels):
         pred = pred.split(os.path.sep)[-1]
@@ -197,6 +934,8 @@ def aggregate_metrics(gt_files: List[str], pred_files: List[str], reorient: bool
         metrics[pred]['Mean'] = np.mean(scores)
         metrics[pred]['Weighted mean'] = average(scores, weights=voxels)
 
+    intervals = {} if bootstrap == 0 else bootstrap_metrics(common_voxels, all_voxels, gt_voxels, dice_scores, indices,
+                                                            bootstrap, confidence)
     common_voxels = np.sum(common_voxels, axis=0)
     all_voxels = np.sum(all_voxels, axis=0)
 
@@ -210,31 +949,98 @@ def aggregate_metrics(gt_files: List[str], pred_files: List[str], reorient: bool
     metrics['Weighted mean']['Mean'] = np.mean(scores)
     metrics['Weighted mean']['Weighted mean'] = average(scores, weights=np.sum(gt_voxels, axis=0))
 
-    scores = []
-    for common, both in zip(common_voxels, all_voxels):
-        if both == 0:
-            scores.append(1.0)
-        else:
-            scores.append(2 * common / both)
+    scores = dice_from_counts(common_voxels, all_voxels)
     metrics['Global dice'] = {label: score for label, score in zip(index_keys, scores)}
     metrics['Global dice']['Mean'] = np.mean(scores)
     metrics['Global dice']['Weighted mean'] = average(scores, weights=np.sum(gt_voxels, axis=0))
+
+    if hd95 is not None:
+        for row, values in (('HD95', hd95), ('NSD', nsd)):
+            scores = np.array([nan_average(x) for x in np.transpose(values)])
+            metrics[row] = {label: score for label, score in zip(index_keys, scores)}
+            metrics[row]['Mean'] = nan_average(scores)
+            metrics[row]['Weighted mean'] = nan_average(scores, weights=np.sum(gt_voxels, axis=0))
+
+    metrics.update(intervals)
+    return metrics
+
+
+def resample_counts(cases: int, resamples: int, seed: int = 0) -> ndarray:
+    """ Draws `resamples` bootstrap resamples of `cases` cases with replacement using a fixed `seed`, returning the
+    number of times each case is drawn by each resample as a `(resamples, cases)` matrix.
+    """
+    draws = np.random.default_rng(seed).integers(0, cases, size=(resamples, cases))
+    draws += cases * np.arange(resamples)[:, None]
+    return np.bincount(draws.ravel(), minlength=resamples * cases).reshape(resamples, cases)
+
+
+def row_average(x: ndarray, weights: ndarray) -> ndarray:
+    """ Averages each row of `x` using the matching row of `weights`, falling back to the mean for the rows whose
+    weights are all zero (see `average`).
+    """
+    total = weights.sum(axis=1)
+    weighted = (x * weights).sum(axis=1) / np.where(total == 0, 1, total)
+    return np.where(total == 0, x.mean(axis=1), weighted)
+
+
+def bootstrap_metrics(common_voxels: ndarray, all_voxels: ndarray, gt_voxels: ndarray, dice_scores: ndarray,
+                      indices: dict, resamples: int, confidence: float = 0.95, seed: int = 0) -> dict:
+    """ Calculates percentile bootstrap confidence intervals of the per-label mean, weighted mean and Global Dice, and
+    of their mean and weighted mean over the labels, from the metrics collected for each case (see
+    `summarize_metrics`). The volumes are not read again: all the resamples are drawn at once as a matrix of case
+    counts (see `resample_counts`), and the statistics of every resample are computed from the per-case arrays using
+    matrix products. Returns the lower and upper bounds as the "Mean CI low", "Mean CI high", "Weighted mean CI low",
+    "Weighted mean CI high", "Global dice CI low" and "Global dice CI high" rows.
+    """
+    assert 0 < confidence < 1, f'The confidence level must be between 0 and 1, is {confidence}.'
+    counts = resample_counts(len(dice_scores), resamples, seed).astype(np.float64)
+    case_weights = counts * np.sum(gt_voxels, axis=1)
+    label_weights = counts @ gt_voxels
+    totals = case_weights.sum(axis=1)[:, None]
+    mean = counts @ dice_scores / len(dice_scores)
+    statistics = {
+        'Mean': mean,
+        # Resamples without GT voxels fall back to the mean, as in `average`
+        'Weighted mean': np.where(totals == 0, mean, (case_weights @ dice_scores) / np.where(totals == 0, 1, totals)),
+        'Global dice': dice_from_counts(counts @ common_voxels, counts @ all_voxels),
+    }
+
+    alpha = 100 * (1 - confidence) / 2
+    metrics = {}
+    for row, scores in statistics.items():
+        scores = np.column_stack([scores, scores.mean(axis=1), row_average(scores, label_weights)])
+        low, high = np.percentile(scores, [alpha, 100 - alpha], axis=0)
+        for bound, values in (('low', low), ('high', high)):
+            metrics[f'{row} CI {bound}'] = dict(zip([*indices.keys(), 'Mean', 'Weighted mean'], values))
     return metrics
 
 
-def write_metrics(output_path: str, metrics: dict, indices: dict, console: bool):
-    """ Writes the metrics to the csv or json file. Also prints to console if `console` is `True`.
+def write_metrics(output_path: str, metrics: dict, indices: dict, console: bool, models: bool = False):
+    """ Writes the metrics to the csv or json file. Also prints to console if `console` is `True`. If `models` is
+    `True`, `metrics` maps model names to metrics and the csv file has an additional "Model" column. Undefined (NaN)
+    values, e.g. the HD95 of a label never found in both the GT and the prediction, are written as `null` in json and
+    as `nan` in csv.
     """
-    json_str = json.dumps(metrics, indent=2)
     if console:
-        print(json_str)
+        print(json.dumps(json_compatible(metrics), indent=2))
     if output_path is not None:
         with open(output_path, 'w') as f:
-            if output_path.endswith('.json'):
-                f.write(json_str)
-            else:
-                columns = ['Cases', *indices.keys(), 'Mean', 'Weighted mean']
-                f.write(','.join(columns) + '\n')
-                for key, mapping in metrics.items():
-                    row = map(str, [key, *mapping.values()])
-                    f.write(','.join(row) + '\n')
+            f.write(format_metrics(output_path, metrics, indices, models))
+
+
+def format_metrics(output_path: str, metrics: dict, indices: dict, models: bool = False) -> str:
+    """ Formats the metrics as the content of the csv or json file `output_path` (see `write_metrics`).
+    """
+    if output_path.endswith('.json'):
+        return json.dumps(json_compatible(metrics), indent=2, allow_nan=False)
+    columns = ['Cases', *indices.keys(), 'Mean', 'Weighted mean']
+    if models:
+        lines = [','.join(['Model', *columns])]
+        for model, model_metrics in metrics.items():
+            for key, mapping in model_metrics.items():
+                lines.append(','.join(map(str, [model, key, *mapping.values()])))
+    else:
+        lines = [','.join(columns)]
+        for key, mapping in metrics.items():
+            lines.append(','.join(map(str, [key, *mapping.values()])))
+    return ''.join(x + '\n' for x in lines)
@@ -0,0 +1,110 @@
+import json
+from typing import List, Sequence, TextIO, Tuple, Union
+
+import numpy as np
+from numpy import ndarray
+
+from dice_score_3d.cache import atomic_write
+
+
+def partial_header(indices: dict, models: Sequence[Union[str, None]], reorient: bool, dtype: np.dtype,
+                   shard: Tuple[int, int] = (0, 1), surface_tolerance: Union[float, None] = None,
+                   num_cases: Union[int, None] = None) -> dict:
+    """ Describes the evaluation which produced a partial results file. Partial results can only be merged when their
+    headers match, except for the shard index. `num_cases` is the number of matched cases of all the shards, so that
+    interrupted shards can be told apart from finished ones. The surface tolerance is only described when the HD95 and
+    NSD are computed.
+    """
+    header = {
+        'indices': dict(indices),
+        'models': list(models),
+        'reorient': reorient,
+        'dtype': np.dtype(dtype).name,
+        'shard': list(shard),
+    }
+    if num_cases is not None:
+        header['cases'] = num_cases
+    if surface_tolerance is not None:
+        header['surface_tolerance'] = surface_tolerance
+    return header
+
+
+def json_compatible(x):
+    """ Replaces the NaN values of nested dicts and lists, e.g. the undefined HD95 of a label found in only the GT or
+    only the prediction, with `None`, so that they are written as `null` instead of the non-standard `NaN` of `json`.
+    """
+    if isinstance(x, dict):
+        return {key: json_compatible(value) for key, value in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [json_compatible(value) for value in x]
+    if isinstance(x, float) and np.isnan(x):
+        return None
+    return x
+
+
+def case_record(index: int, gt: str, preds: Sequence[str], scores: Sequence[tuple]) -> dict:
+    """ Creates the partial results record of a case, holding the common, both and GT voxel counts and the Dice scores
+    of each prediction (one for each model), followed by their HD95 and NSD when computed, an undefined HD95 being
+    `None`. `index` is the position of the case among all the matched cases.
+    """
+    record = {
+        'index': index,
+        'case': gt,
+        'predictions': list(preds),
+        'common_voxels': [np.asarray(x[0]).tolist() for x in scores],
+        'all_voxels': [np.asarray(x[1]).tolist() for x in scores],
+        'gt_voxels': [np.asarray(x[2]).tolist() for x in scores],
+        'dice': [np.asarray(x[3]).tolist() for x in scores],
+    }
+    if len(scores) > 0 and len(scores[0]) > 4:
+        record['hd95'] = [json_compatible(np.asarray(x[4]).tolist()) for x in scores]
+        record['nsd'] = [np.asarray(x[5]).tolist() for x in scores]
+    return record
+
+
+def record_counts(record: dict) -> List[Tuple[ndarray, ndarray, ndarray]]:
+    """ Returns the common, both and GT voxel counts of each prediction of a case record.
+    """
+    return [(np.array(a), np.array(b), np.array(c))
+            for a, b, c in zip(record['common_voxels'], record['all_voxels'], record['gt_voxels'])]
+
+
+def record_surface_metrics(record: dict) -> List[Tuple[ndarray, ...]]:
+    """ Returns the HD95 and NSD of each prediction of a case record, or an empty tuple for each prediction when they
+    were not computed. An undefined HD95, stored as `None`, is returned as NaN.
+    """
+    if 'hd95' not in record:
+        return [() for _ in record['predictions']]
+    return [(np.array(a, dtype=np.float64), np.array(b, dtype=np.float64))
+            for a, b in zip(record['hd95'], record['nsd'])]
+
+
+def write_partial(path: str, header: dict, records: Sequence[dict]):
+    """ Writes a partial results file in the JSON lines format: the header on the first line followed by one record
+    for each case. The file is replaced atomically, so an existing file is never left partially written.
+    """
+    atomic_write(path, lambda f: f.write(''.join(json.dumps(x) + '\n' for x in [header, *records]).encode()))
+
+
+def append_record(f: TextIO, record: dict):
+    """ Appends a case record to an open partial results file, flushing it so that the record survives if the process
+    is killed.
+    """
+    f.write(json.dumps(record) + '\n')
+    f.flush()
+
+
+def read_partial(path: str) -> Tuple[dict, List[dict]]:
+    """ Reads a partial results file, returning its header and its case records. A truncated last line, left by a
+    process killed while appending a record, is ignored.
+    """
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    records = []
+    for i, line in enumerate(lines):
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            assert i == len(lines) - 1, f'{path} is corrupted at line {i + 1}.'
+    assert len(records) > 0 and 'indices' in records[0], f'{path} is not a partial results file.'
+    return records[0], records[1:]
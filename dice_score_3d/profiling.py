@@ -0,0 +1,75 @@
+import json
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Union
+
+import numpy as np
+
+STAGES = ('read', 'reorient', 'cast', 'score')
+
+
+@contextmanager
+def timed(stats: Union[dict, None], stage: str) -> Iterator[None]:
+    """ Adds the wall time spent in the `with` block to `stats[stage]`. Does nothing if `stats` is `None`.
+    """
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats[stage] = stats.get(stage, 0.0) + time.perf_counter() - start
+
+
+def summarize_profile(profiles: List[dict], outlier_threshold: float = 3.0) -> dict:
+    """ Summarizes the per-case profiles, returning the total and mean time spent in each stage, the share of each stage
+    from the total time, the number of bytes read and the peak array memory. Cases whose total time exceeds the median
+    by more than `outlier_threshold` median absolute deviations are reported as outliers.
+    """
+    if len(profiles) == 0:
+        return {'cases': 0}
+    totals = np.array([x['total'] for x in profiles])
+    total = float(totals.sum())
+    summary = {
+        'cases': len(profiles),
+        'total': total,
+        'stages': {},
+        'bytes_read': int(sum(x['bytes_read'] for x in profiles)),
+        'array_bytes': int(sum(x['array_bytes'] for x in profiles)),
+        'peak_array_bytes': int(max(x['peak_array_bytes'] for x in profiles)),
+    }
+    for stage in STAGES:
+        stage_total = float(sum(x.get(stage, 0.0) for x in profiles))
+        summary['stages'][stage] = {
+            'total': stage_total,
+            'mean': stage_total / len(profiles),
+            'share': stage_total / total if total > 0 else 0.0,
+        }
+
+    median = np.median(totals)
+    deviation = np.median(np.abs(totals - median))
+    outliers = [x for x in profiles if x['total'] > median + outlier_threshold * max(deviation, 1e-3 * median)]
+    summary['outliers'] = [{'case': x['case'], 'total': x['total'],
+                            'slowest_stage': max(STAGES, key=lambda stage: x.get(stage, 0.0))}
+                           for x in sorted(outliers, key=lambda x: x['total'], reverse=True)]
+    return summary
+
+
+def format_summary(summary: dict) -> str:
+    """ Formats the share of each stage from the total time in a single line.
+    """
+    if summary['cases'] == 0:
+        return 'No cases were profiled'
+    shares = ', '.join(f"{stage} {x['share']:.1%}" for stage, x in summary['stages'].items())
+    return f"Profiled {summary['cases']} cases in {summary['total']:.2f}s: {shares}. " \
+           f"Outliers: {len(summary['outliers'])}"
+
+
+def write_profile(output_path: str, profiles: List[dict]) -> dict:
+    """ Writes the per-case profiles and their summary to a json trace file, returning the summary.
+    """
+    summary = summarize_profile(profiles)
+    with open(output_path, 'w') as f:
+        json.dump({'summary': summary, 'cases': profiles}, f, indent=2)
+    return summary
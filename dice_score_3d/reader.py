@@ -1,16 +1,339 @@
+import os.path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterator, List, Sequence, Tuple, Union
+
 import SimpleITK as sitk
 import numpy as np
 from numpy import ndarray
 
+from dice_score_3d.cache import VolumeCache
+from dice_score_3d.profiling import timed
+
+# The file formats whose regions are read without decoding the whole file by SimpleITK
+STREAMING_SUFFIXES = ('.mha', '.mhd', '.nii', '.nii.gz')
+NRRD_TYPES = {
+    **dict.fromkeys(['signed char', 'int8', 'int8_t'], np.int8),
+    **dict.fromkeys(['uchar', 'unsigned char', 'uint8', 'uint8_t'], np.uint8),
+    **dict.fromkeys(['short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'], np.int16),
+    **dict.fromkeys(['ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'], np.uint16),
+    **dict.fromkeys(['int', 'signed int', 'int32', 'int32_t'], np.int32),
+    **dict.fromkeys(['uint', 'unsigned int', 'uint32', 'uint32_t'], np.uint32),
+    **dict.fromkeys(['longlong', 'long long', 'long long int', 'signed long long', 'signed long long int', 'int64',
+                     'int64_t'], np.int64),
+    **dict.fromkeys(['ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'], np.uint64),
+    'float': np.float32,
+    'double': np.float64,
+}
 
-def read_mask(path: str, reorient: bool, dtype: np.dtype) -> ndarray:
+
+def read_mask(path: str, reorient: bool, dtype: np.dtype, stats: Union[dict, None] = None,
+              volume_cache: Union[VolumeCache, None] = None) -> ndarray:
     """ Reads a 3D volume using SimpleITK and returns the segmentation mask as a ndarray.
     Args:
         path (str): The path to the location of the segmentation mask.
         reorient (bool): If `True`, the segmentation mask is reoriented to the "LPS" orientation.
         dtype (np.dtype): The data type of the returned ndarray.
+        stats (Union[dict, None]): If given, the reading statistics are added to it (see `read_volume`).
+        volume_cache (Union[VolumeCache, None]): If given, the cache of decoded segmentation masks (see `read_volume`).
     """
-    img = sitk.ReadImage(path)
+    return read_volume(path, reorient, dtype, stats, volume_cache)[0]
+
+
+def read_volume(path: str, reorient: bool, dtype: np.dtype, stats: Union[dict, None] = None,
+                volume_cache: Union[VolumeCache, None] = None) -> Tuple[ndarray, dict]:
+    """ Reads a 3D volume using SimpleITK and returns the segmentation mask as a ndarray, together with its geometry
+    (see `image_geometry`).
+    Args:
+        path (str): The path to the location of the segmentation mask.
+        reorient (bool): If `True`, the segmentation mask is reoriented to the "LPS" orientation.
+        dtype (np.dtype): The data type of the returned ndarray.
+        stats (Union[dict, None]): If given, the time spent reading, reorienting and casting the segmentation mask and
+            the number of bytes read and decoded are added to it. The returned array is added to the live array bytes,
+            which are used for tracking the peak array memory.
+        volume_cache (Union[VolumeCache, None]): If given, the decoded segmentation mask is memory-mapped from the cache
+            when available, and stored in the cache otherwise. Memory-mapped masks are read-only.
+    """
+    if volume_cache is not None:
+        key = volume_cache.key(path, reorient, dtype)
+        with timed(stats, 'read'):
+            cached = volume_cache.get(key)
+        if cached is not None:
+            array = cached[0]
+            if stats is not None:
+                stats['bytes_read'] = stats.get('bytes_read', 0) + array.nbytes
+                stats['array_bytes'] = stats.get('array_bytes', 0) + array.nbytes
+                track_array_bytes(stats, array.nbytes)
+                stats['live_array_bytes'] = stats.get('live_array_bytes', 0) + array.nbytes
+            return cached
+
+    with timed(stats, 'read'):
+        img = sitk.ReadImage(path)
     if reorient:
-        img = sitk.DICOMOrient(img)
-    return sitk.GetArrayFromImage(img).astype(dtype, copy=False)
+        with timed(stats, 'reorient'):
+            img = sitk.DICOMOrient(img)
+    with timed(stats, 'cast'):
+        array = sitk.GetArrayFromImage(img).astype(dtype, copy=False)
+    if stats is not None:
+        image_bytes = img.GetNumberOfPixels() * img.GetNumberOfComponentsPerPixel() * img.GetSizeOfPixelComponent()
+        stats['bytes_read'] = stats.get('bytes_read', 0) + os.path.getsize(path)
+        stats['array_bytes'] = stats.get('array_bytes', 0) + array.nbytes
+        track_array_bytes(stats, image_bytes + array.nbytes)
+        stats['live_array_bytes'] = stats.get('live_array_bytes', 0) + array.nbytes
+    geometry = image_geometry(img)
+    if volume_cache is not None:
+        volume_cache.put(key, array, geometry)
+    return array, geometry
+
+
+def image_geometry(img: sitk.Image) -> dict:
+    """ Returns the size, spacing, origin and direction of an image. The sizes are in SimpleITK (x, y, z) order.
+    """
+    return {
+        'size': img.GetSize(),
+        'spacing': img.GetSpacing(),
+        'origin': img.GetOrigin(),
+        'direction': img.GetDirection(),
+    }
+
+
+def signed_permutation(direction: Sequence[float], tolerance: float = 1e-6) -> Union[ndarray, None]:
+    """ Returns a 3D direction matrix as a signed permutation matrix, or `None` if the direction is not axis-aligned
+    (e.g. oblique) within `tolerance`.
+    """
+    if len(direction) != 9:
+        return None
+    matrix = np.reshape(direction, (3, 3))
+    rounded = np.round(matrix)
+    if not np.allclose(matrix, rounded, rtol=0, atol=tolerance) or \
+            not np.array_equal(np.sort(np.abs(rounded), axis=None), [0] * 6 + [1] * 3) or \
+            np.linalg.matrix_rank(rounded) != 3:
+        return None
+    return rounded.astype(int)
+
+
+def relative_permutation(direction: Sequence[float], reference_direction: Sequence[float],
+                         tolerance: float = 1e-6) -> Union[ndarray, None]:
+    """ Returns the signed permutation matrix `relative` matching the index axes of an image with `direction` to the
+    index axes of an image with `reference_direction`: `relative[k, j]` is +-1 when the index axis j runs along the
+    reference index axis k, in the same or in the opposite direction. Equal directions give the identity. Returns
+    `None` when the directions differ and are not both axis-aligned, e.g. for oblique directions.
+    """
+    if len(direction) == len(reference_direction) and \
+            np.allclose(direction, reference_direction, rtol=0, atol=tolerance):
+        return np.eye(int(round(np.sqrt(len(direction)))), dtype=int)
+    source = signed_permutation(direction, tolerance)
+    reference = signed_permutation(reference_direction, tolerance)
+    if source is None or reference is None:
+        return None
+    return reference.T @ source
+
+
+def align_axes(values: Sequence, direction: Sequence[float], reference_direction: Sequence[float]) \
+        -> Union[tuple, None]:
+    """ Reorders per-axis values in SimpleITK (x, y, z) order, e.g. the size or the spacing of an image with
+    `direction`, to the axis order of an image with `reference_direction`. Returns `None` when the axes cannot be
+    matched (see `relative_permutation`).
+    """
+    relative = relative_permutation(direction, reference_direction)
+    if relative is None or len(relative) != len(values):
+        return None
+    return tuple(values[int(np.flatnonzero(row)[0])] for row in relative)
+
+
+def align_orientation(array: ndarray, direction: Sequence[float], reference_direction: Sequence[float],
+                      tolerance: float = 1e-6) -> Union[ndarray, None]:
+    """ Returns `array`, whose image has `direction`, in the voxel order of an image with `reference_direction`. When
+    both directions are equal, `array` is returned as is. When both directions are axis-aligned, a transposed and
+    flipped view of `array` is returned, without copying it. Returns `None` otherwise, e.g. for oblique directions.
+    The voxels are matched exactly as if both images were reoriented to "LPS" using `sitk.DICOMOrient`.
+    """
+    relative = relative_permutation(direction, reference_direction, tolerance)
+    if relative is None:
+        return None
+    if np.array_equal(relative, np.eye(len(relative))):
+        return array
+    # The SimpleITK (x, y, z) axes are reversed in the ndarray
+    axes = [2 - int(np.flatnonzero(relative[2 - i])[0]) for i in range(3)]
+    flips = tuple(slice(None, None, -1) if relative[2 - i].sum() < 0 else slice(None) for i in range(3))
+    return np.transpose(array, axes)[flips]
+
+
+def reorient_array(array: ndarray, direction: Sequence[float]) -> ndarray:
+    """ Reorients an array, whose image has `direction`, to the "LPS" orientation using `sitk.DICOMOrient`.
+    """
+    img = sitk.GetImageFromArray(np.asarray(array))
+    img.SetDirection(tuple(direction))
+    return sitk.GetArrayFromImage(sitk.DICOMOrient(img))
+
+
+def align_masks(gt: Tuple[ndarray, dict], pred: Tuple[ndarray, dict], stats: Union[dict, None] = None) \
+        -> Tuple[ndarray, ndarray]:
+    """ Brings a GT and a prediction, given with their geometries (see `read_volume`), to the same voxel order, as
+    required by `--reorient`. The prediction is returned as a view in the GT voxel order when possible (see
+    `align_orientation`), otherwise both are reoriented to "LPS" using `sitk.DICOMOrient`.
+    """
+    with timed(stats, 'reorient'):
+        aligned = align_orientation(pred[0], pred[1]['direction'], gt[1]['direction'])
+        if aligned is not None:
+            return gt[0], aligned
+        return reorient_array(gt[0], gt[1]['direction']), reorient_array(pred[0], pred[1]['direction'])
+
+
+def aligned_spacing(gt: dict, pred: dict, reorient: bool) -> Tuple[float, ...]:
+    """ Returns the voxel spacing, in ndarray (z, y, x) order, of the masks of a GT and a prediction with these
+    geometries, as returned by `align_masks` if `reorient` is `True`, or as read otherwise.
+    """
+    if not reorient or relative_permutation(pred['direction'], gt['direction']) is not None:
+        return tuple(reversed(gt['spacing']))
+    img = sitk.Image([1] * len(gt['spacing']), sitk.sitkUInt8)
+    img.SetSpacing(tuple(gt['spacing']))
+    img.SetDirection(tuple(gt['direction']))
+    return tuple(reversed(sitk.DICOMOrient(img).GetSpacing()))
+
+
+def read_aligned_masks(paths: Sequence[str], reorient: bool, dtype: np.dtype, stats: Union[dict, None] = None,
+                       volume_cache: Union[VolumeCache, None] = None) -> List[Tuple[ndarray, ndarray, tuple]]:
+    """ Reads a GT (the first path) and its predictions (the other paths), returning the GT and prediction masks and
+    their voxel spacing (see `aligned_spacing`) for each prediction. If `reorient` is `True`, each pair is brought to
+    the same voxel order using `align_masks`, without reorienting the volumes when their orientations already match.
+    """
+    gt = read_volume(paths[0], False, dtype, stats, volume_cache)
+    preds = [read_volume(path, False, dtype, stats, volume_cache) for path in paths[1:]]
+    if not reorient:
+        return [(gt[0], pred[0], aligned_spacing(gt[1], pred[1], False)) for pred in preds]
+    return [(*align_masks(gt, pred, stats), aligned_spacing(gt[1], pred[1], True)) for pred in preds]
+
+
+def track_array_bytes(stats: dict, transient_bytes: int):
+    """ Updates the peak array memory using the live array bytes and the bytes of the arrays allocated only for the
+    current step.
+    """
+    stats['peak_array_bytes'] = max(stats.get('peak_array_bytes', 0),
+                                    stats.get('live_array_bytes', 0) + transient_bytes)
+
+
+def read_header(path: str) -> dict:
+    """ Reads only the header of a 3D volume, returning its size, spacing, origin, direction and pixel type. The sizes
+    are in SimpleITK (x, y, z) order, which is reversed compared to the ndarray shape.
+    Args:
+        path (str): The path to the location of the volume.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return {
+        'size': reader.GetSize(),
+        'spacing': reader.GetSpacing(),
+        'origin': reader.GetOrigin(),
+        'direction': reader.GetDirection(),
+        'pixel_type': sitk.GetPixelIDValueAsString(reader.GetPixelID()),
+    }
+
+
+def raw_nrrd_layout(path: str) -> Union[Tuple[str, int, np.dtype, Tuple[int, ...]], None]:
+    """ Parses the header of a .nrrd or .nhdr file, returning the path of its data, the offset of the voxels in that
+    file, their data type and the ndarray shape when the voxels are stored uncompressed in a single file. Returns `None`
+    otherwise, e.g. for compressed data.
+    """
+    fields = {}
+    with open(path, 'rb') as f:
+        if not f.readline().startswith(b'NRRD'):
+            return None
+        for line in f:
+            line = line.decode('latin-1').rstrip('\r\n')
+            if line == '':
+                break
+            if not line.startswith('#') and ': ' in line:
+                key, value = line.split(': ', 1)
+                fields[key.strip().lower()] = value.strip()
+        header_size = f.tell()
+    data_type = NRRD_TYPES.get(fields.get('type', ''))
+    data_file = fields.get('data file', fields.get('datafile'))
+    if fields.get('encoding') != 'raw' or data_type is None or fields.get('dimension') != '3' or \
+            int(fields.get('line skip', fields.get('lineskip', 0))) != 0 or \
+            (data_file is not None and (data_file.startswith('LIST') or ' ' in data_file)):
+        return None
+    data_type = np.dtype(data_type).newbyteorder('>' if fields.get('endian') == 'big' else '<')
+    shape = tuple(int(x) for x in reversed(fields['sizes'].split()))
+    data_path = path if data_file is None else os.path.join(os.path.dirname(path), data_file)
+    offset = int(fields.get('byte skip', fields.get('byteskip', 0)))
+    if offset == -1:
+        # The voxels are at the end of the file
+        offset = os.path.getsize(data_path) - int(np.prod(shape)) * data_type.itemsize
+    elif data_file is None:
+        offset += header_size
+    return data_path, offset, data_type, shape
+
+
+def read_slabs(path: str, dtype: np.dtype, slab_size: int) -> Iterator[ndarray]:
+    """ Reads a 3D segmentation mask in slabs of `slab_size` slices along the z axis, yielding each slab as a ndarray.
+    Only the requested region is read for the file formats which support streaming (.mha, .mhd, .nii and .nii.gz
+    using SimpleITK, and uncompressed .nrrd by reading its raw voxels directly), so the peak memory is bounded by the
+    slab size instead of the volume size. The other formats are read whole, with a warning, since SimpleITK would decode
+    the whole file again for each slab.
+    Args:
+        path (str): The path to the location of the segmentation mask.
+        dtype (np.dtype): The data type of the returned ndarrays.
+        slab_size (int): The number of slices of each slab.
+    """
+    assert slab_size > 0, f'The slab size must be positive, is {slab_size}.'
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    assert len(size) == 3, f'Slab-wise reading requires 3D volumes, {path} has size {size}.'
+    layout = raw_nrrd_layout(path) if path.endswith(('.nrrd', '.nhdr')) else None
+    if layout is not None and layout[3] == tuple(reversed(size)):
+        data_path, offset, data_type, shape = layout
+        slice_size = shape[1] * shape[2]
+        with open(data_path, 'rb') as f:
+            for z in range(0, size[2], slab_size):
+                depth = min(slab_size, size[2] - z)
+                f.seek(offset + z * slice_size * data_type.itemsize)
+                slab = np.fromfile(f, data_type, depth * slice_size).reshape((depth, *shape[1:]))
+                yield slab.astype(dtype, copy=False)
+        return
+    if not path.endswith(STREAMING_SUFFIXES):
+        print(f"Warning: {path} cannot be read slab by slab, reading it whole")
+        volume = read_mask(path, False, dtype)
+        for z in range(0, size[2], slab_size):
+            yield volume[z:z + slab_size]
+        return
+    for z in range(0, size[2], slab_size):
+        reader.SetExtractIndex((0, 0, z))
+        reader.SetExtractSize((size[0], size[1], min(slab_size, size[2] - z)))
+        yield sitk.GetArrayFromImage(reader.Execute()).astype(dtype, copy=False)
+
+
+def prefetch_masks(files: List[Sequence[str]], reorient: bool, dtype: np.dtype, prefetch: int,
+                   stats: Union[List[dict], None] = None,
+                   volume_cache: Union[VolumeCache, None] = None) -> Iterator[List[Tuple[ndarray, ndarray, tuple]]]:
+    """ Reads groups of segmentation masks (a GT and its predictions) in background threads, yielding the GT and
+    prediction masks of each group, with their spacing, in order (see `read_aligned_masks`). At most `prefetch` groups
+    are read ahead of the consumer, which bounds the memory used by the decoded masks.
+    Args:
+        files (List[Sequence[str]]): The paths to the segmentation masks of each group, the GT being first.
+        reorient (bool): If `True`, the GT and prediction masks are brought to the same voxel order.
+        dtype (np.dtype): The data type of the returned ndarrays.
+        prefetch (int): The maximum number of groups read ahead, which is also the number of reader threads.
+        stats (Union[List[dict], None]): If given, the reading statistics of each group (see `read_mask`) are appended
+            to it before yielding the masks of the group.
+        volume_cache (Union[VolumeCache, None]): If given, the cache of decoded segmentation masks (see `read_mask`).
+    """
+    assert prefetch > 0, f'The number of prefetched groups must be positive, is {prefetch}.'
+
+    def read_group(paths: Sequence[str]) -> Tuple[List[Tuple[ndarray, ndarray, tuple]], Union[dict, None]]:
+        group_stats = None if stats is None else {'case': paths[0]}
+        return read_aligned_masks(paths, reorient, dtype, group_stats, volume_cache), group_stats
+
+    groups = iter(files)
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = deque(executor.submit(read_group, paths) for paths in islice(groups, prefetch))
+        while len(pending) > 0:
+            masks, group_stats = pending.popleft().result()
+            pending.extend(executor.submit(read_group, paths) for paths in islice(groups, 1))
+            if stats is not None:
+                stats.append(group_stats)
+            yield masks
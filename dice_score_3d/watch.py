@@ -0,0 +1,178 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Sequence, Set, Tuple, Union
+
+import numpy as np
+from numpy import ndarray
+
+from dice_score_3d.cache import atomic_write, file_identity
+from dice_score_3d.metrics import ENGINES, format_metrics, multi_class_dice, stack_scores, summarize_metrics, \
+    thread_count, write_metrics
+from dice_score_3d.reader import align_masks, read_volume
+
+
+def watch_predictions(ground_truths: str, predictions: str, output_path: Union[str, None], indices: dict,
+                      reorient: bool = False, dtype: str = 'uint8', prefix: str = '', suffix: str = '.nii.gz',
+                      console: bool = False, engine: str = 'loop', num_threads: int = 1, poll_interval: float = 10.0,
+                      timeout: Union[float, None] = None, gt_cache_size: int = 16) -> dict:
+    """ Watches a folder where predictions are being written and evaluates each prediction against its GT as soon as
+    the prediction is completely written, i.e. its size and modification time did not change between two consecutive
+    polls. Predictions which are written again are evaluated again, and removed predictions are dropped. A prediction
+    which cannot be evaluated, e.g. because its shape does not match its GT, is reported and left out of the results
+    until it is written again. The aggregated results are refreshed in the csv or json output file after each poll
+    which evaluated new predictions, so they can be followed while the predictions are being written. Returns the
+    aggregated results of the evaluated predictions when all the GT files have an evaluated (or failed) prediction, or
+    when no prediction changed for `timeout` seconds. The results are the same as evaluating the folders using
+    `dice_metrics`.
+
+    Args:
+        ground_truths (str): Path to the folder with all the GT volumes.
+        predictions (str): Path to the watched folder where the predicted volumes are written. The name of the
+            prediction files must match the name of the GT files, other files are ignored.
+        output_path (Union[str, None]): The output path to write the computed metrics. Can be a csv or json file,
+            depending on extension. If `None`, the metrics will not be written to a file.
+        indices (dict): Dictionary describing the indices used for calculating the Dice Similarity Coefficient.
+            Example: `{"lung_left": 1, "lung_right": 2}`.
+        reorient (bool): If `True`, brings the GT and the prediction to the same voxel order (see `dice_metrics`).
+            Default: `False`.
+        dtype (str): Must be either "uint8" when having less than 255 classes, or "uint16" otherwise.
+            Default: `'uint8'`.
+        prefix (str): Only the files with this prefix are considered. Default: `''`
+        suffix (str): Only the files with this suffix are considered. Default: `'.nii.gz'`.
+        console (bool): If `True`, also prints the final Dice metrics to console. Default: `False`.
+        engine (str): The engine used for counting voxels, one of "loop", "histogram" or "bbox". Default: `'loop'`.
+        num_threads (int): Number of threads used to evaluate each volume. If `0`, uses all the CPUs. Default: `1`.
+        poll_interval (float): The number of seconds between two polls of the predictions folder. Default: `10.0`.
+        timeout (Union[float, None]): Stops watching when no prediction was added, changed or removed for this many
+            seconds. If `None`, watches until all the GT files have a prediction. Default: `None`.
+        gt_cache_size (int): The number of decoded GT volumes kept in memory, so that a GT is not decoded again when
+            its prediction is written again. Default: `16`.
+    """
+    assert os.path.isdir(ground_truths) and os.path.isdir(predictions), \
+        'Watching requires both the GT path and the prediction path to be folders.'
+    if output_path is not None:
+        assert output_path.endswith('.csv') or output_path.endswith('.json'), (
+            f'If output path is not None, it must be either .csv or .json, is {output_path}')
+    assert all([isinstance(x, int) for x in indices.values()]), f'Indices must be integers, found {indices.values()}.'
+    assert engine in ENGINES, f'Engine must be one of {ENGINES}, is {engine}.'
+    assert poll_interval > 0, f'The poll interval must be positive, is {poll_interval}.'
+    assert gt_cache_size > 0, f'The GT cache size must be positive, is {gt_cache_size}.'
+    dtype = np.uint8 if dtype == 'uint8' else np.uint16
+    num_threads = thread_count(0, num_threads)
+    read_gt = cached_volume_reader(dtype, gt_cache_size)
+    observed = {}
+    evaluated = {}
+    scores = {}
+    metrics = {}
+    last_change = time.monotonic()
+    print(f"Watching {predictions}")
+    while True:
+        gt_names, current, changed, ready = poll_predictions(ground_truths, predictions, prefix, suffix, observed,
+                                                             evaluated)
+        observed = current
+        removed = set(evaluated) - set(current)
+        new_scores, failed = evaluate_ready(ready, ground_truths, predictions, read_gt, reorient, dtype, indices,
+                                            engine, num_threads)
+        for name in [*removed, *failed]:
+            scores.pop(name, None)
+            evaluated.pop(name, None)
+        scores.update(new_scores)
+        evaluated.update((x, current[x]) for x in [*new_scores, *failed])
+        updated = len(removed) > 0 or len(new_scores) > 0 or len(failed) > 0
+
+        now = time.monotonic()
+        if len(changed) > 0 or updated:
+            last_change = now
+        if updated and len(scores) > 0:
+            names = sorted(scores)
+            metrics = summarize_metrics([os.path.join(predictions, x) for x in names],
+                                        *stack_scores([scores[x] for x in names]), indices)
+            refresh_metrics(output_path, metrics, indices)
+            print(f"Evaluated {len(scores)} of {len(gt_names)} cases")
+        if len(gt_names) > 0 and gt_names <= set(evaluated):
+            break
+        if timeout is not None and now - last_change >= timeout:
+            print(f"No prediction changed for {timeout} seconds, stopping")
+            break
+        time.sleep(poll_interval)
+
+    assert len(scores) > 0, f'No predictions were evaluated in {predictions}.'
+    write_metrics(None, metrics, indices, console)
+    return metrics
+
+
+def cached_volume_reader(dtype: np.dtype, cache_size: int) -> Callable[[str], Tuple[ndarray, dict]]:
+    """ Returns a function reading volumes (see `read_volume`) which keeps the last `cache_size` decoded volumes in
+    memory, so that a volume which did not change is not decoded again.
+    """
+    cache = OrderedDict()
+
+    def read(path: str) -> Tuple[ndarray, dict]:
+        key = file_identity(path)
+        if key not in cache:
+            cache[key] = read_volume(path, False, dtype)
+            while len(cache) > cache_size:
+                cache.popitem(last=False)
+        cache.move_to_end(key)
+        return cache[key]
+
+    return read
+
+
+def poll_predictions(ground_truths: str, predictions: str, prefix: str, suffix: str,
+                     observed: Dict[str, Tuple[int, int]], evaluated: Dict[str, Tuple[int, int]]) \
+        -> Tuple[Set[str], Dict[str, Tuple[int, int]], List[str], List[str]]:
+    """ Lists the names of the GT files, and the size and modification time of each prediction of the watched folder
+    which has a GT. Predictions removed while listing the folder are ignored. Also returns the names of the predictions
+    added, changed or removed since the `observed` poll, and the names of the non-empty predictions which did not
+    change since the `observed` poll, i.e. which are completely written, and were not `evaluated` in this state yet.
+    """
+    gt_names = {x for x in os.listdir(ground_truths) if x.startswith(prefix) and x.endswith(suffix)}
+    current = {}
+    for entry in os.scandir(predictions):
+        if entry.name in gt_names:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            current[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    changed = [x for x in current if current[x] != observed.get(x)] + [x for x in observed if x not in current]
+    ready = sorted(x for x in current if current[x] == observed.get(x) and current[x] != evaluated.get(x)
+                   and current[x][0] > 0)
+    return gt_names, current, changed, ready
+
+
+def evaluate_ready(names: Sequence[str], ground_truths: str, predictions: str,
+                   read_gt: Callable[[str], Tuple[ndarray, dict]], reorient: bool, dtype: np.dtype, indices: dict,
+                   engine: str, num_threads: int) -> Tuple[Dict[str, tuple], List[str]]:
+    """ Evaluates the completely written predictions with these names against their GT read using `read_gt`,
+    returning the voxel counts and Dice scores of each evaluated prediction, and the names of the predictions which
+    could be read but not evaluated, e.g. because their shape does not match their GT. Predictions which cannot be read
+    yet are skipped, and retried at the next poll.
+    """
+    ret = {}
+    failed = []
+    for name in names:
+        try:
+            gt = read_gt(os.path.join(ground_truths, name))
+            pred = read_volume(os.path.join(predictions, name), False, dtype)
+        except RuntimeError as e:  # Not readable yet, retried at the next poll
+            print(f"Could not read {name}: {e}")
+            continue
+        try:
+            gt_mask, pred_mask = align_masks(gt, pred) if reorient else (gt[0], pred[0])
+            ret[name] = multi_class_dice(gt_mask, pred_mask, tuple(indices.values()), engine, num_threads)
+        except Exception as e:  # Not retried until the prediction is written again
+            print(f"Could not evaluate {name}: {e}")
+            failed.append(name)
+    return ret, failed
+
+
+def refresh_metrics(output_path: Union[str, None], metrics: dict, indices: dict):
+    """ Replaces the output file with the metrics atomically (see `atomic_write`), so that readers of the output file
+    never see a partially written file.
+    """
+    if output_path is None:
+        return
+    atomic_write(output_path, lambda f: f.write(format_metrics(output_path, metrics, indices).encode()))
@@ -0,0 +1,79 @@
+import unittest
+
+import numpy as np
+
+from dice_score_3d import DiceAccumulator
+from dice_score_3d.metrics import multi_class_dice, stack_scores, summarize_metrics
+
+
+def create_cases(n, seed=0):
+    rng = np.random.default_rng(seed)
+    cases = []
+    for i in range(n):
+        gt = rng.integers(0, 4, (10, 11, 12), dtype=np.uint8)
+        pred = rng.integers(0, 4, (10, 11, 12), dtype=np.uint8)
+        pred[pred == 3] = 0
+        cases.append((gt, pred, f'case_{i}'))
+    return cases
+
+
+class TestAccumulator(unittest.TestCase):
+    def assertMetricsAlmostEqual(self, first, second):
+        self.assertEqual(first.keys(), second.keys())
+        for key in first:
+            self.assertEqual(first[key].keys(), second[key].keys())
+            for label in first[key]:
+                self.assertAlmostEqual(first[key][label], second[key][label])
+
+    def test_metrics(self):
+        indices = {'a': 1, 'b': 2, 'c': 3, 'd': 7}
+        cases = create_cases(5)
+        scores = stack_scores([multi_class_dice(gt, pred, tuple(indices.values())) for gt, pred, _ in cases])
+        expected = summarize_metrics([x[2] for x in cases], *scores, indices)
+
+        accumulator = DiceAccumulator(indices, keep_cases=True).update(cases)
+        self.assertEqual(accumulator.num_cases, 5)
+        self.assertMetricsAlmostEqual(accumulator.metrics(), expected)
+
+        accumulator = DiceAccumulator(indices, engine='histogram').update(iter(cases))
+        self.assertMetricsAlmostEqual(accumulator.metrics(),
+                                      {x: expected[x] for x in ('Mean', 'Weighted mean', 'Global dice')})
+
+    def test_merge(self):
+        indices = {'a': 1, 'b': 2, 'c': 3}
+        cases = create_cases(6)
+        expected = DiceAccumulator(indices, keep_cases=True).update(cases).metrics()
+
+        first = DiceAccumulator(indices, keep_cases=True).update(cases[:2])
+        second = DiceAccumulator(indices, keep_cases=True).update(cases[2:])
+        first += second
+        self.assertEqual(first.num_cases, 6)
+        self.assertMetricsAlmostEqual(first.metrics(), expected)
+
+        # Cases with the same id would overwrite each other, the counts being accumulated twice
+        self.assertRaisesRegex(AssertionError, 'Case case_0 was already accumulated', first.add, *cases[0])
+        self.assertRaisesRegex(AssertionError, r"the same case ids: \['case_2', 'case_3'\]", first.merge,
+                               DiceAccumulator(indices, keep_cases=True).update(cases[2:4]))
+        self.assertEqual(first.num_cases, 6)
+        self.assertMetricsAlmostEqual(first.metrics(), expected)
+
+        # Default case ids are only unique within an accumulator
+        unnamed = [(gt, pred, None) for gt, pred, _ in cases]
+        first = DiceAccumulator(indices, keep_cases=True).update(unnamed[:2])
+        second = DiceAccumulator(indices, keep_cases=True).update(unnamed[2:4])
+        self.assertEqual(list(first.cases), ['0', '1'])
+        self.assertRaisesRegex(AssertionError, r"the same case ids: \['0', '1'\]", first.merge, second)
+        self.assertEqual(first.num_cases, 2)
+        self.assertEqual(DiceAccumulator(indices).update(unnamed[:2]).merge(
+            DiceAccumulator(indices).update(unnamed[2:4])).num_cases, 4)
+
+        self.assertRaises(AssertionError, first.merge, DiceAccumulator({'a': 1}))
+        self.assertRaisesRegex(AssertionError, 'different indices', first.merge,
+                               DiceAccumulator({'b': 2, 'a': 1, 'c': 3}, keep_cases=True))
+        self.assertRaisesRegex(AssertionError, 'keeping the metrics of each case', first.merge,
+                               DiceAccumulator(indices))
+        self.assertRaises(AssertionError, DiceAccumulator(indices).metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
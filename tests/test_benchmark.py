@@ -0,0 +1,34 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from dice_score_3d.benchmark import create_label_map, create_prediction, run_benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_create_label_map(self):
+        rng = np.random.default_rng(0)
+        volume = create_label_map((40, 50, 60), 5, 0.1, np.uint8, rng)
+        self.assertEqual(volume.shape, (40, 50, 60))
+        self.assertEqual(volume.dtype, np.uint8)
+        self.assertEqual(set(np.unique(volume)), set(range(6)))
+        self.assertAlmostEqual((volume > 0).mean(), 0.1, delta=0.03)
+
+        prediction = create_prediction(volume, rng)
+        self.assertEqual(prediction.shape, volume.shape)
+        self.assertEqual(np.count_nonzero(prediction), np.count_nonzero(volume))
+
+    def test_run_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            results = run_benchmark(tmp, cases=2, size=(10, 11, 12), labels=3, sparsity=0.2, dtype='uint8',
+                                    suffix='.nii.gz', compress=False, engines=['loop', 'histogram'], num_workers=0,
+                                    repeats=1)
+        self.assertEqual(results['labels'], 3)
+        self.assertEqual(set(results['stages']), {'read', 'reorient', 'cast', 'score', 'aggregate'})
+        self.assertEqual(set(results['stages']['score']), {'loop', 'histogram'})
+        self.assertEqual(set(results['end_to_end']['loop']), {'serial'})
+
+
+if __name__ == '__main__':
+    unittest.main()
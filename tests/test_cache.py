@@ -0,0 +1,121 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from dice_score_3d import dice_metrics
+from dice_score_3d.cache import ResultCache, VolumeCache
+from dice_score_3d.reader import read_mask
+from tests.utils import create_and_write_volume, create_case_folders
+
+
+class TestCache(unittest.TestCase):
+    def test_put_get(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'volume.nii.gz')
+            create_and_write_volume(path)
+            cache = ResultCache(os.path.join(tmp, 'cache'))
+            key = cache.key(path, path, False, np.uint8, [1, 2])
+
+            self.assertIsNone(cache.get(key))
+            cache.put(key, np.array([1, 2]), np.array([3, 4]), np.array([5, 6]))
+            common_voxels, all_voxels, gt_voxels = cache.get(key)
+            self.assertTrue(np.array_equal(common_voxels, [1, 2]))
+            self.assertTrue(np.array_equal(all_voxels, [3, 4]))
+            self.assertTrue(np.array_equal(gt_voxels, [5, 6]))
+            # An entry evicted by another process while being read is a cache miss
+            with mock.patch('dice_score_3d.cache.os.utime', side_effect=FileNotFoundError):
+                self.assertIsNone(cache.get(key))
+
+            self.assertNotEqual(key, cache.key(path, path, True, np.uint8, [1, 2]))
+            self.assertNotEqual(key, cache.key(path, path, False, np.uint16, [1, 2]))
+            self.assertNotEqual(key, cache.key(path, path, False, np.uint8, [1, 3]))
+            os.utime(path, ns=(0, 0))
+            self.assertNotEqual(key, cache.key(path, path, False, np.uint8, [1, 2]))
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ResultCache(tmp, max_entries=2)
+            for i, key in enumerate(['a', 'b', 'c']):
+                cache.put(key, np.array([i]), np.array([i]), np.array([i]))
+                os.utime(os.path.join(tmp, key + '.npz'), ns=(i, i))
+            cache.evict()
+            self.assertIsNone(cache.get('a'))
+            self.assertIsNotNone(cache.get('b'))
+            self.assertIsNotNone(cache.get('c'))
+            cache.clear()
+            self.assertIsNone(cache.get('c'))
+
+    def test_dice_metrics_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp)
+            cache_dir = os.path.join(tmp, 'cache')
+            indices = {'a': 1, 'b': 2, 'c': 3}
+
+            expected = dice_metrics(gt_dir, pred_dir, None, indices)
+            self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, cache_dir=cache_dir), expected)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, cache_dir=cache_dir), expected)
+
+            # A changed prediction is evaluated again
+            create_and_write_volume(os.path.join(pred_dir, 'case_0.nii.gz'))
+            os.utime(os.path.join(pred_dir, 'case_0.nii.gz'), ns=(0, 0))
+            expected = dice_metrics(gt_dir, pred_dir, None, indices)
+            self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, cache_dir=cache_dir), expected)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+
+
+class TestVolumeCache(unittest.TestCase):
+    def test_read_mask(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'volume.nii.gz')
+            create_and_write_volume(path)
+            cache = VolumeCache(os.path.join(tmp, 'cache'))
+            key = cache.key(path, True, np.uint8)
+            self.assertIsNone(cache.get(key))
+
+            expected = read_mask(path, True, np.uint8)
+            self.assertTrue(np.array_equal(read_mask(path, True, np.uint8, volume_cache=cache), expected))
+            array, geometry = cache.get(key)
+            self.assertIsInstance(array, np.memmap)
+            self.assertEqual(array.dtype, np.uint8)
+            self.assertEqual(tuple(geometry['size'][::-1]), expected.shape)
+            self.assertTrue(np.array_equal(read_mask(path, True, np.uint8, volume_cache=cache), expected))
+
+            self.assertNotEqual(key, cache.key(path, False, np.uint8))
+            self.assertNotEqual(key, cache.key(path, True, np.uint16))
+            os.utime(path, ns=(0, 0))
+            self.assertNotEqual(key, cache.key(path, True, np.uint8))
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = VolumeCache(tmp, max_size=2.5 * 1024 / 2 ** 30)
+            for i, key in enumerate(['a', 'b', 'c']):
+                cache.put(key, np.full(1024, i, dtype=np.uint8), {})
+                os.utime(os.path.join(tmp, key + '.npy'), ns=(i, i))
+            cache.evict()
+            self.assertIsNone(cache.get('a'))
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'a.json')))
+            self.assertTrue(np.all(cache.get('c')[0] == 2))
+            with mock.patch('dice_score_3d.cache.os.utime', side_effect=FileNotFoundError):
+                self.assertIsNone(cache.get('c'))
+            cache.clear()
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_dice_metrics_volume_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp)
+            cache_dir = os.path.join(tmp, 'volumes')
+            indices = {'a': 1, 'b': 2, 'c': 3}
+
+            expected = dice_metrics(gt_dir, pred_dir, None, indices)
+            for num_workers, prefetch in ((0, 0), (0, 2), (2, 0)):
+                self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, num_workers=num_workers,
+                                              prefetch=prefetch, volume_cache_dir=cache_dir), expected)
+                self.assertEqual(len([x for x in os.listdir(cache_dir) if x.endswith('.npy')]), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import argparse
+import os
+import tempfile
+import unittest
+
+from dice_score_3d.main import parse_model, parse_models, parse_shard
+
+
+class TestMain(unittest.TestCase):
+    def test_parse_model(self):
+        self.assertEqual(parse_model('unet=/data/unet/predictions'), ('unet', '/data/unet/predictions'))
+        self.assertEqual(parse_model('/data/unet/'), ('unet', '/data/unet/'))
+        with tempfile.TemporaryDirectory() as tmp:
+            # An existing path containing "=" is not split into a name and a path
+            path = os.path.join(tmp, 'lr=0.01')
+            os.makedirs(path)
+            self.assertEqual(parse_model(path), ('lr=0.01', path))
+            self.assertEqual(parse_model(f'best={path}'), ('best', path))
+
+    def test_parse_models(self):
+        self.assertEqual(parse_models(['a=/data/x', '/data/y']), {'a': '/data/x', 'y': '/data/y'})
+
+        # Unnamed models with the same last component are named after their full path
+        self.assertEqual(parse_models(['/data/unet/predictions', '/data/nnunet/predictions']),
+                         {'/data/unet/predictions': '/data/unet/predictions',
+                          '/data/nnunet/predictions': '/data/nnunet/predictions'})
+        self.assertEqual(parse_models(['predictions=/data/unet', '/data/nnunet/predictions']),
+                         {'predictions': '/data/unet', '/data/nnunet/predictions': '/data/nnunet/predictions'})
+
+        self.assertRaisesRegex(AssertionError, r"Duplicate model names found: \['unet'\]", parse_models,
+                               ['unet=/data/x', 'unet=/data/y'])
+        # The full path of an unnamed model can still collide with an explicit name
+        self.assertRaisesRegex(AssertionError, r"Duplicate model names found: \['/data/x'\]", parse_models,
+                               ['/data/x=/data/y', '/data/x', '/other/x'])
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('3/16'), (3, 16))
+        self.assertRaises(argparse.ArgumentTypeError, parse_shard, '3')
+        self.assertRaises(argparse.ArgumentTypeError, parse_shard, '16/16')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,15 @@
+import json
 import os
 import tempfile
 import unittest
+from unittest import mock
 
 import numpy as np
 
-from dice_score_3d import dice_metrics
-from dice_score_3d.metrics import dice, multi_class_dice, evaluate_prediction
-from tests.utils import create_and_write_volume
+from dice_score_3d import dice_metrics, merge_partials
+from dice_score_3d.metrics import bootstrap_metrics, dice, multi_class_dice, evaluate_prediction, \
+    execute_evaluate_predictions, preflight, stack_scores, summarize_metrics, surface_metrics, surface_voxels
+from tests.utils import create_and_write_volume, create_case_folders, create_random_volume, write_volume
 
 
 class TestMetrics(unittest.TestCase):
@@ -32,6 +35,93 @@ class TestMetrics(unittest.TestCase):
         _, _, _, dice_scores = multi_class_dice(x, y, [7, 8])
         self.assertTrue(all([x == 1.0 for x in dice_scores]))
 
+    def test_histogram_engine(self):
+        x = np.random.randint(0, 5, (20, 21, 22), dtype=np.uint8)
+        y = np.random.randint(0, 5, (20, 21, 22), dtype=np.uint8)
+        y[y == 3] = 0  # Label 3 is missing from the prediction
+
+        for indices in ([1, 2, 3], [4, 2, 2], [7, 8], [0, 1, 2, 3, 4, 300]):
+            expected = multi_class_dice(x, y, indices, engine='loop')
+            actual = multi_class_dice(x, y, indices, engine='histogram')
+            for a, b in zip(expected, actual):
+                self.assertTrue(np.array_equal(a, b))
+
+        x = x.astype(np.uint16) * 1000
+        y = y.astype(np.uint16) * 1000
+        for indices in ([1000, 2000, 3000], list(range(0, 10000, 2))):
+            expected = multi_class_dice(x, y, indices, engine='loop')
+            actual = multi_class_dice(x, y, indices, engine='histogram')
+            for a, b in zip(expected, actual):
+                self.assertTrue(np.array_equal(a, b))
+
+    def test_bbox_engine(self):
+        x = np.random.randint(0, 5, (20, 21, 22), dtype=np.uint8)
+        y = np.random.randint(0, 5, (20, 21, 22), dtype=np.uint8)
+        y[y == 3] = 0
+        for indices in ([1, 2, 3], [4, 2, 2], [7, 8], [0, 1, 2, 3, 4, 300]):
+            expected = multi_class_dice(x, y, indices, engine='loop')
+            actual = multi_class_dice(x, y, indices, engine='bbox')
+            for a, b in zip(expected, actual):
+                self.assertTrue(np.array_equal(a, b))
+
+        # Small structures in a mostly-background volume
+        x = np.zeros((40, 41, 42), dtype=np.uint16)
+        y = np.zeros((40, 41, 42), dtype=np.uint16)
+        x[2:6, 3:9, 4:7] = 1
+        y[3:7, 3:9, 5:8] = 1
+        x[30:35, 30:35, 30:35] = 2
+        y[1:3, 1:3, 1:3] = 2
+        x[10:12, 20:22, 30:32] = 1000
+        expected = multi_class_dice(x, y, [1, 2, 5, 1000], engine='loop')
+        actual = multi_class_dice(x, y, [1, 2, 5, 1000], engine='bbox')
+        for a, b in zip(expected, actual):
+            self.assertTrue(np.array_equal(a, b))
+
+    def test_multi_class_dice_threads(self):
+        x = np.random.randint(0, 5, (20, 21, 22), dtype=np.uint8)
+        y = np.random.randint(0, 5, (20, 21, 22), dtype=np.uint8)
+        y[y == 3] = 0
+        for engine in ('loop', 'histogram', 'bbox'):
+            expected = multi_class_dice(x, y, [1, 2, 3, 7], engine)
+            for num_threads in (2, 3, 64):
+                actual = multi_class_dice(x, y, [1, 2, 3, 7], engine, num_threads)
+                for a, b in zip(expected, actual):
+                    self.assertTrue(np.array_equal(a, b))
+        self.assertRaises(AssertionError, multi_class_dice, x, y[1:], [1])
+
+    def test_surface_metrics(self):
+        def ball(center, radius):
+            z, y, x = np.indices((30, 32, 34))
+            return (z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 <= radius ** 2
+
+        def brute_force(a, b, spacing, tolerance):
+            a = np.argwhere(surface_voxels(a)) * spacing
+            b = np.argwhere(surface_voxels(b)) * spacing
+            distances = np.sqrt(((a[:, None] - b[None]) ** 2).sum(axis=-1))
+            a_to_b, b_to_a = distances.min(axis=1), distances.min(axis=0)
+            return max(np.percentile(a_to_b, 95), np.percentile(b_to_a, 95)), \
+                (np.sum(a_to_b <= tolerance) + np.sum(b_to_a <= tolerance)) / (len(a_to_b) + len(b_to_a))
+
+        gt = np.zeros((30, 32, 34), dtype=np.uint8)
+        pred = np.zeros((30, 32, 34), dtype=np.uint8)
+        gt[ball((15, 16, 17), 8)] = 1
+        pred[ball((15, 18, 14), 7)] = 1
+        gt[ball((3, 4, 30), 4)] = 2  # Touches the border of the volume
+        pred[ball((4, 4, 29), 4)] = 2
+        gt[20:, :4, :5] = 3  # Missing from the prediction
+        spacing = (2.0, 1.0, 0.5)
+        hd95, nsd = surface_metrics(gt, pred, [1, 2, 3, 4], spacing, 1.5)
+        for label in (1, 2):
+            expected_hd95, expected_nsd = brute_force(gt == label, pred == label, spacing, 1.5)
+            self.assertAlmostEqual(hd95[label - 1], expected_hd95, places=5)
+            self.assertAlmostEqual(nsd[label - 1], expected_nsd)
+        self.assertTrue(np.isnan(hd95[2]))
+        self.assertEqual((nsd[2], hd95[3], nsd[3]), (0.0, 0.0, 1.0))
+
+        hd95, nsd = surface_metrics(gt, gt, [2, 1], spacing, 0.0)
+        self.assertTrue(np.array_equal(hd95, [0.0, 0.0]))
+        self.assertTrue(np.array_equal(nsd, [1.0, 1.0]))
+
     def test_evaluate_prediction(self):
         tmp = tempfile.NamedTemporaryFile(suffix='.nii.gz', delete=False)
         try:
@@ -43,6 +133,24 @@ class TestMetrics(unittest.TestCase):
             tmp.close()
             os.unlink(tmp.name)
 
+    def test_evaluate_prediction_slabs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for suffix in ('.nii.gz', '.nrrd'):
+                gt = os.path.join(tmp, 'gt' + suffix)
+                pred = os.path.join(tmp, 'pred' + suffix)
+                create_and_write_volume(gt)
+                create_and_write_volume(pred)
+                for engine in ('loop', 'histogram', 'bbox'):
+                    expected = evaluate_prediction(gt, pred, False, np.uint8, [1, 2, 3, 7], engine)
+                    for slab_size in (1, 3, 100):
+                        actual = evaluate_prediction(gt, pred, False, np.uint8, [1, 2, 3, 7], engine, slab_size)
+                        for a, b in zip(expected, actual):
+                            self.assertTrue(np.array_equal(a, b))
+
+            create_and_write_volume(pred, size=(22, 21, 19))
+            self.assertRaisesRegex(AssertionError, 'have different sizes', evaluate_prediction, gt, pred, False,
+                                   np.uint8, [1, 2], 'loop', 4)
+
     def test_dice_metrics(self):
         self.assertRaisesRegex(AssertionError, 'Prediction path and GT path must both be a single file or a folder',
                                dice_metrics, './', './random_string?.!@3$not_a_path', 'results.csv', {'Lung': 1})
@@ -52,6 +160,161 @@ class TestMetrics(unittest.TestCase):
         self.assertRaisesRegex(AssertionError, 'Indices must be integers, found .*',
                                dice_metrics, './', './', 'results.csv', {'Lung': 'text'})
 
+    def test_dice_metrics_prefetch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=4)
+            indices = {'a': 1, 'b': 2, 'c': 3}
+            expected = dice_metrics(gt_dir, pred_dir, None, indices)
+            self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, prefetch=2), expected)
+
+    def test_dice_metrics_models(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=3)
+            other_dir = os.path.join(tmp, 'other')
+            os.makedirs(other_dir)
+            for x in os.listdir(pred_dir):
+                create_and_write_volume(os.path.join(other_dir, x))
+            indices = {'a': 1, 'b': 2, 'c': 3}
+            expected = {'pred': dice_metrics(gt_dir, pred_dir, None, indices),
+                        'other': dice_metrics(gt_dir, other_dir, None, indices)}
+
+            self.assertEqual(dice_metrics(gt_dir, [pred_dir, other_dir], None, indices), expected)
+            self.assertEqual(dice_metrics(gt_dir, {'m1': pred_dir, 'm2': other_dir}, None, indices, num_workers=2,
+                                          prefetch=2),
+                             {'m1': expected['pred'], 'm2': expected['other']})
+
+            output_path = os.path.join(tmp, 'results.csv')
+            dice_metrics(gt_dir, {'m1': pred_dir, 'm2': other_dir}, output_path, indices)
+            with open(output_path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[0], 'Model,Cases,a,b,c,Mean,Weighted mean')
+            self.assertEqual(len(lines), 1 + 2 * (3 + 3))
+            self.assertTrue(lines[1].startswith('m1,case_0.nii.gz,'))
+
+            os.remove(os.path.join(other_dir, 'case_0.nii.gz'))
+            self.assertRaises(AssertionError, dice_metrics, gt_dir, [pred_dir, other_dir], None, indices)
+
+    def test_dice_metrics_surface(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=3)
+            indices = {'a': 1, 'b': 2, 'c': 3}
+            expected = dice_metrics(gt_dir, pred_dir, None, indices, surface_tolerance=1.0)
+            self.assertEqual({x: expected[x] for x in expected if x not in ('HD95', 'NSD')},
+                             dice_metrics(gt_dir, pred_dir, None, indices))
+            self.assertEqual(list(expected['NSD']), ['a', 'b', 'c', 'Mean', 'Weighted mean'])
+            self.assertTrue(all(0.0 <= x <= 1.0 for x in expected['NSD'].values()))
+            self.assertTrue(all(x >= 0.0 for x in expected['HD95'].values()))
+
+            cache_dir = os.path.join(tmp, 'cache')
+            for kwargs in ({'num_workers': 2}, {'prefetch': 2}, {'cache_dir': cache_dir}, {'reorient': True}):
+                self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, surface_tolerance=1.0, **kwargs),
+                                 expected)
+
+            partials = [os.path.join(tmp, f'partial_{i}.jsonl') for i in range(2)]
+            for i, path in enumerate(partials):
+                dice_metrics(gt_dir, pred_dir, None, indices, shard=(i, 2), partial_path=path, surface_tolerance=1.0)
+            self.assertEqual(merge_partials(partials, None), expected)
+            self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, partial_path=partials[0], resume=True,
+                                          shard=(0, 2), surface_tolerance=1.0), merge_partials(partials[:1], None))
+            self.assertRaisesRegex(AssertionError, 'Slab-wise evaluation does not support surface metrics',
+                                   dice_metrics, gt_dir, pred_dir, None, indices, slab_size=4, surface_tolerance=1.0)
+
+    def test_surface_metrics_json(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=2)
+            for i in range(2):
+                create_and_write_volume(os.path.join(pred_dir, f'case_{i}.nii.gz'), high=4)
+            indices = {'a': 1, 'd': 4}  # Label 4 is never predicted, so its HD95 is undefined in every case
+            output_path = os.path.join(tmp, 'results.json')
+            partial_path = os.path.join(tmp, 'partial.jsonl')
+            metrics = dice_metrics(gt_dir, pred_dir, output_path, indices, partial_path=partial_path,
+                                   surface_tolerance=1.0)
+            self.assertTrue(np.isnan(metrics['HD95']['d']))
+            self.assertEqual(metrics['NSD']['d'], 0.0)
+            with open(output_path) as f:
+                results = json.loads(f.read(), parse_constant=self.fail)
+            self.assertIsNone(results['HD95']['d'])
+            self.assertEqual(results['HD95']['Mean'], metrics['HD95']['Mean'])
+            with open(partial_path) as f:
+                self.assertIsNone(json.loads(f.read().splitlines()[1], parse_constant=self.fail)['hd95'][0][1])
+
+            merged_path = os.path.join(tmp, 'merged.json')
+            merge_partials([partial_path], merged_path)
+            with open(merged_path) as f:
+                self.assertEqual(json.load(f), results)
+
+    def test_bootstrap_metrics(self):
+        cases = [tuple(np.random.randint(0, 4, (8, 9, 10), dtype=np.uint8) for _ in range(2)) for _ in range(7)]
+        cases[2][0][:] = 0  # A case without GT voxels
+        indices = {'a': 1, 'b': 2, 'c': 3, 'd': 5}
+        scores = stack_scores([multi_class_dice(gt, pred, tuple(indices.values())) for gt, pred in cases])
+        actual = bootstrap_metrics(*scores, indices, 50, confidence=0.9, seed=3)
+
+        # Evaluates each resample separately, using the same draws
+        draws = np.random.default_rng(3).integers(0, len(cases), size=(50, len(cases)))
+        resampled = [summarize_metrics([f'case_{i}' for i in range(len(cases))], *[x[draw] for x in scores], indices)
+                     for draw in draws]
+        for row in ('Mean', 'Weighted mean', 'Global dice'):
+            for column in (*indices, 'Mean', 'Weighted mean'):
+                values = [x[row][column] for x in resampled]
+                self.assertAlmostEqual(actual[f'{row} CI low'][column], np.percentile(values, 5))
+                self.assertAlmostEqual(actual[f'{row} CI high'][column], np.percentile(values, 95))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=4)
+            output_path = os.path.join(tmp, 'results.csv')
+            expected = dice_metrics(gt_dir, pred_dir, None, indices)
+            metrics = dice_metrics(gt_dir, pred_dir, output_path, indices, bootstrap=100)
+            self.assertEqual({x: metrics[x] for x in expected}, expected)
+            rows = [f'{x} CI {y}' for x in ('Mean', 'Weighted mean', 'Global dice') for y in ('low', 'high')]
+            self.assertEqual(list(metrics)[len(expected):], rows)
+            self.assertTrue(all(metrics['Global dice CI low'][x] <= metrics['Global dice'][x] <=
+                                metrics['Global dice CI high'][x] for x in indices))
+            with open(output_path) as f:
+                self.assertEqual(len(f.read().splitlines()), 1 + 4 + 3 + 6)
+
+            partial_path = os.path.join(tmp, 'partial.jsonl')
+            dice_metrics(gt_dir, pred_dir, None, indices, partial_path=partial_path)
+            self.assertEqual(merge_partials([partial_path], None, bootstrap=100), metrics)
+            self.assertRaisesRegex(AssertionError, 'The confidence level must be between 0 and 1', dice_metrics,
+                                   gt_dir, pred_dir, None, indices, bootstrap=100, confidence=95)
+
+    def test_preflight(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=4)
+            create_and_write_volume(os.path.join(gt_dir, 'case_1.nii.gz'), size=(40, 30, 20))
+            create_and_write_volume(os.path.join(pred_dir, 'case_1.nii.gz'), size=(40, 30, 20))
+            gt_files = [os.path.join(gt_dir, f'case_{i}.nii.gz') for i in range(4)]
+            pred_files = [(os.path.join(pred_dir, f'case_{i}.nii.gz'),) for i in range(4)]
+            small, large = 2 * 22 * 21 * 20, 2 * 40 * 30 * 20
+            self.assertEqual(preflight(gt_files, pred_files, False), [small, large, small, small])
+
+            # The largest case is scheduled first, the results being returned in the original order
+            indices = {'a': 1, 'b': 2, 'c': 3}
+            expected = dice_metrics(gt_dir, pred_dir, None, indices)
+            self.assertEqual(list(expected)[:4], [f'case_{i}.nii.gz' for i in range(4)])
+            self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, num_workers=2), expected)
+
+            # The callback is called as soon as each case is finished, even before the cases scheduled earlier
+            positions = []
+            serial = execute_evaluate_predictions(gt_files, pred_files, False, np.uint8, (1, 2, 3), 0)
+            with mock.patch('dice_score_3d.metrics.as_completed', side_effect=lambda fs: reversed(list(fs))):
+                scores = execute_evaluate_predictions(gt_files, pred_files, False, np.uint8, (1, 2, 3), 2,
+                                                      callback=lambda i, x: positions.append(i))
+            self.assertEqual(positions, [3, 2, 0, 1])
+            self.assertEqual(len(scores), 4)
+            for x, y in zip(scores, serial):
+                self.assertTrue(all(np.array_equal(a, b) for a, b in zip(x[0], y[0])))
+
+            # A permuted prediction matches its GT only when reorienting
+            volume, spacing, origin, _ = create_random_volume(size=(40, 20, 30))
+            write_volume(pred_files[1][0], volume, spacing, origin, (0.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0))
+            self.assertEqual(len(preflight(gt_files, pred_files, True)), 4)
+            self.assertRaisesRegex(AssertionError, 'The size of 1 predictions does not match the size of their GT',
+                                   preflight, gt_files, pred_files, False)
+            self.assertRaisesRegex(AssertionError, 'does not match the size of their GT', dice_metrics, gt_dir,
+                                   pred_dir, None, indices, num_workers=2)
+
 
 if __name__ == '__main__':
     unittest.main()
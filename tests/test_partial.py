@@ -0,0 +1,113 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from dice_score_3d import dice_metrics, merge_partials
+from dice_score_3d.partial import read_partial
+from tests.utils import create_and_write_volume, create_case_folders
+
+
+class TestPartial(unittest.TestCase):
+    def test_merge_shards(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=5)
+            indices = {'a': 1, 'b': 2, 'c': 3}
+            output_path = os.path.join(tmp, 'results.csv')
+            expected = dice_metrics(gt_dir, pred_dir, output_path, indices)
+            with open(output_path) as f:
+                expected_csv = f.read()
+
+            partials = [os.path.join(tmp, f'partial_{i}.jsonl') for i in range(3)]
+            for i, path in enumerate(partials):
+                dice_metrics(gt_dir, pred_dir, None, indices, shard=(i, 3), partial_path=path)
+            header, records = read_partial(partials[1])
+            self.assertEqual(header['shard'], [1, 3])
+            self.assertEqual(header['cases'], 5)
+            self.assertEqual([x['index'] for x in records], [1, 4])
+
+            self.assertEqual(merge_partials(partials[::-1], output_path), expected)
+            with open(output_path) as f:
+                self.assertEqual(f.read(), expected_csv)
+
+            # An interrupted shard and a missing shard are reported
+            with open(partials[1]) as f:
+                lines = f.readlines()
+            with open(partials[1], 'w') as f:
+                f.writelines(lines[:2])
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                merge_partials(partials[:2], None)
+            self.assertIn('Warning: 2 of the 5 cases are missing', stdout.getvalue())
+            self.assertIn('Missing shards: [2], incomplete (e.g. interrupted) shards: [1] of 3', stdout.getvalue())
+
+            # A shard without cases only writes the header of its partial results file
+            partials = [os.path.join(tmp, f'partial_{i}_of_8.jsonl') for i in range(8)]
+            for i, path in enumerate(partials):
+                dice_metrics(gt_dir, pred_dir, None, indices, shard=(i, 8), partial_path=path)
+            header, records = read_partial(partials[6])
+            self.assertEqual((header['shard'], header['cases'], records), ([6, 8], 5, []))
+            self.assertEqual(dice_metrics(gt_dir, pred_dir, output_path, indices, shard=(7, 8)), {})
+            with open(output_path) as f:
+                self.assertEqual(f.read(), expected_csv)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                self.assertEqual(merge_partials(partials, None), expected)
+            self.assertNotIn('Missing', stdout.getvalue())
+
+            self.assertRaisesRegex(AssertionError, 'does not match the other shards', merge_partials,
+                                   [partials[0], partials[0]], None)
+            dice_metrics(gt_dir, pred_dir, None, {'a': 1}, shard=(2, 3), partial_path=partials[2])
+            self.assertRaisesRegex(AssertionError, 'was written by a different evaluation', merge_partials, partials,
+                                   None)
+            self.assertRaisesRegex(AssertionError, 'The shard index must be between 0 and the shard count',
+                                   dice_metrics, gt_dir, pred_dir, None, indices, shard=(3, 3))
+
+    def test_merge_models(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=3)
+            other_dir = os.path.join(tmp, 'other')
+            os.makedirs(other_dir)
+            for x in os.listdir(pred_dir):
+                create_and_write_volume(os.path.join(other_dir, x))
+            models = {'m1': pred_dir, 'm2': other_dir}
+            indices = {'a': 1, 'b': 2, 'c': 3}
+            expected = dice_metrics(gt_dir, models, None, indices)
+
+            partials = [os.path.join(tmp, f'partial_{i}.jsonl') for i in range(2)]
+            for i, path in enumerate(partials):
+                dice_metrics(gt_dir, models, None, indices, shard=(i, 2), partial_path=path)
+            self.assertEqual(merge_partials(partials, None), expected)
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=4)
+            indices = {'a': 1, 'b': 2, 'c': 3}
+            partial_path = os.path.join(tmp, 'partial.jsonl')
+            profile_path = os.path.join(tmp, 'profile.json')
+            expected = dice_metrics(gt_dir, pred_dir, None, indices, partial_path=partial_path)
+            with open(partial_path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(len(lines), 5)
+
+            # Simulates an evaluation killed while appending the third case
+            with open(partial_path, 'w') as f:
+                f.write('\n'.join(lines[:3] + [lines[3][:20]]))
+            for num_workers in (0, 2):
+                self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, num_workers=num_workers,
+                                              profile_path=profile_path, partial_path=partial_path, resume=True),
+                                 expected)
+                with open(profile_path) as f:
+                    self.assertEqual(json.load(f)['summary']['cases'], 2 if num_workers == 0 else 0)
+            _, records = read_partial(partial_path)
+            self.assertEqual(sorted(x['index'] for x in records), [0, 1, 2, 3])
+            self.assertEqual(merge_partials([partial_path], None), expected)
+
+            self.assertRaisesRegex(AssertionError, 'was written by a different evaluation', dice_metrics, gt_dir,
+                                   pred_dir, None, {'a': 1}, partial_path=partial_path, resume=True)
+            self.assertRaisesRegex(AssertionError, 'Resuming requires a partial results file', dice_metrics, gt_dir,
+                                   pred_dir, None, indices, resume=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from dice_score_3d import dice_metrics
+from dice_score_3d.metrics import evaluate_prediction
+from dice_score_3d.profiling import STAGES, summarize_profile, timed
+from tests.utils import create_and_write_volume, create_case_folders
+
+
+class TestProfiling(unittest.TestCase):
+    def test_timed(self):
+        stats = {}
+        with timed(stats, 'read'):
+            pass
+        with timed(stats, 'read'):
+            pass
+        self.assertGreaterEqual(stats['read'], 0.0)
+        with timed(None, 'read'):
+            pass
+
+    def test_summarize_profile(self):
+        profiles = [{'case': str(i), 'read': 1.0, 'score': 1.0, 'total': 2.0, 'bytes_read': 10, 'array_bytes': 20,
+                     'peak_array_bytes': 20} for i in range(9)]
+        profiles.append({'case': 'slow', 'read': 10.0, 'score': 1.0, 'total': 11.0, 'bytes_read': 10,
+                         'array_bytes': 40, 'peak_array_bytes': 40})
+        summary = summarize_profile(profiles)
+        self.assertEqual(summary['cases'], 10)
+        self.assertAlmostEqual(summary['total'], 29.0)
+        self.assertAlmostEqual(summary['stages']['read']['share'], 19 / 29)
+        self.assertEqual(summary['peak_array_bytes'], 40)
+        self.assertEqual(summary['outliers'], [{'case': 'slow', 'total': 11.0, 'slowest_stage': 'read'}])
+        self.assertEqual(summarize_profile([]), {'cases': 0})
+
+    def test_evaluate_prediction_stats(self):
+        tmp = tempfile.NamedTemporaryFile(suffix='.nii.gz', delete=False)
+        try:
+            create_and_write_volume(tmp.name)
+            stats = {}
+            evaluate_prediction(tmp.name, tmp.name, True, np.uint8, [1, 2, 3], stats=stats)
+            self.assertTrue(all(stats[x] >= 0.0 for x in STAGES))
+            self.assertEqual(stats['bytes_read'], 2 * os.path.getsize(tmp.name))
+            self.assertEqual(stats['array_bytes'], 2 * 22 * 21 * 20)
+            self.assertGreaterEqual(stats['peak_array_bytes'], 2 * 22 * 21 * 20)
+        finally:
+            tmp.close()
+            os.unlink(tmp.name)
+
+    def test_dice_metrics_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=3)
+            profile_path = os.path.join(tmp, 'profile.json')
+            indices = {'a': 1, 'b': 2}
+            expected = dice_metrics(gt_dir, pred_dir, None, indices)
+            for kwargs in ({}, {'prefetch': 2}, {'slab_size': 5}, {'num_workers': 2}):
+                self.assertEqual(dice_metrics(gt_dir, pred_dir, None, indices, profile_path=profile_path, **kwargs),
+                                 expected)
+                with open(profile_path) as f:
+                    trace = json.load(f)
+                self.assertEqual(trace['summary']['cases'], 3)
+                self.assertEqual(len(trace['cases']), 3)
+                self.assertEqual(trace['cases'][0]['case'], os.path.join(gt_dir, 'case_0.nii.gz'))
+                self.assertTrue(all(x['total'] > 0 for x in trace['cases']))
+
+
+if __name__ == '__main__':
+    unittest.main()
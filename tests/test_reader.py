@@ -1,11 +1,14 @@
 import os
 import tempfile
 import unittest
+from unittest import mock
 
+import SimpleITK as sitk
 import numpy as np
 
-from dice_score_3d.reader import read_mask
-from tests.utils import create_and_write_volume
+from dice_score_3d.reader import align_orientation, prefetch_masks, read_aligned_masks, read_header, read_mask, \
+    read_slabs
+from tests.utils import create_and_write_volume, create_case_folders, create_random_volume, write_volume
 
 
 class TestReader(unittest.TestCase):
@@ -49,6 +52,75 @@ class TestReader(unittest.TestCase):
             tmp.close()
             os.unlink(tmp.name)
 
+    def test_align_orientation(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pred_path = os.path.join(tmp, 'pred.nii.gz')
+            gt_path = os.path.join(tmp, 'gt.nii.gz')
+            volume, spacing, origin, _ = create_random_volume(size=(22, 21, 20))
+            identity = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+            for direction in [(0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0),
+                              (0.0, 0.0, -1.0, 1.0, 0.0, 0.0, 0.0, -1.0, 0.0),
+                              (-1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 1.0)]:
+                write_volume(pred_path, volume, spacing, origin, direction)
+                expected = read_mask(pred_path, True, np.uint8)
+                write_volume(gt_path, expected, spacing, origin, identity)
+
+                [(gt, pred, _)] = read_aligned_masks([gt_path, pred_path], True, np.uint8)
+                self.assertTrue(np.array_equal(gt, expected))
+                self.assertTrue(np.array_equal(pred, expected))
+                aligned = align_orientation(volume, direction, identity)
+                self.assertTrue(np.array_equal(aligned, expected))
+                self.assertTrue(np.shares_memory(aligned, volume))
+
+            self.assertIs(align_orientation(volume, identity, identity), volume)
+            oblique = (0.6, 0.8, 0.0, -0.8, 0.6, 0.0, 0.0, 0.0, 1.0)
+            self.assertIsNone(align_orientation(volume, oblique, identity))
+            write_volume(pred_path, volume, spacing, origin, oblique)
+            [(gt, pred, _)] = read_aligned_masks([gt_path, pred_path], True, np.uint8)
+            self.assertTrue(np.array_equal(gt, read_mask(gt_path, True, np.uint8)))
+            self.assertTrue(np.array_equal(pred, read_mask(pred_path, True, np.uint8)))
+
+    def test_prefetch_masks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=5)
+            gt_files = [os.path.join(gt_dir, x) for x in sorted(os.listdir(gt_dir))]
+            pred_files = [os.path.join(pred_dir, x) for x in sorted(os.listdir(pred_dir))]
+            for prefetch in (1, 2, 8):
+                masks = list(prefetch_masks(list(zip(gt_files, pred_files)), False, np.uint8, prefetch))
+                self.assertEqual(len(masks), 5)
+                for [(gt, pred, spacing)], gt_file, pred_file in zip(masks, gt_files, pred_files):
+                    self.assertEqual(spacing, tuple(reversed(read_header(gt_file)['spacing'])))
+                    self.assertTrue(np.array_equal(gt, read_mask(gt_file, False, np.uint8)))
+                    self.assertTrue(np.array_equal(pred, read_mask(pred_file, False, np.uint8)))
+
+    def test_read_slabs(self):
+        tmp = tempfile.NamedTemporaryFile(suffix='.mha', delete=False)
+        try:
+            create_and_write_volume(tmp.name, size=(22, 21, 20))
+            self.assertEqual(read_header(tmp.name)['size'], (20, 21, 22))
+            array = read_mask(tmp.name, reorient=False, dtype=np.uint8)
+            slabs = list(read_slabs(tmp.name, np.uint8, 5))
+            self.assertEqual([x.shape[0] for x in slabs], [5, 5, 5, 5, 2])
+            self.assertTrue(np.array_equal(np.concatenate(slabs), array))
+        finally:
+            tmp.close()
+            os.unlink(tmp.name)
+
+    def test_read_slabs_streaming(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # The number of SimpleITK reads: one per slab when streaming, none for raw .nrrd, one for the whole file
+            for suffix, compress, reads in (('.mha', False, 5), ('.nrrd', False, 0), ('.nhdr', False, 0),
+                                            ('.nrrd', True, 1), ('.gipl', False, 1)):
+                path = os.path.join(tmp, 'volume' + suffix)
+                volume = np.random.randint(0, 300, (22, 21, 20), dtype=np.uint16)
+                sitk.WriteImage(sitk.GetImageFromArray(volume), path, compress)
+                with mock.patch.object(sitk.ImageFileReader, 'Execute', autospec=True,
+                                       side_effect=sitk.ImageFileReader.Execute) as execute:
+                    slabs = list(read_slabs(path, np.uint16, 5))
+                self.assertEqual(execute.call_count, reads)
+                self.assertEqual([x.shape[0] for x in slabs], [5, 5, 5, 5, 2])
+                self.assertTrue(np.array_equal(np.concatenate(slabs), volume))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,68 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from dice_score_3d import dice_metrics, watch_predictions
+from tests.utils import create_and_write_volume, create_case_folders
+
+
+class TestWatch(unittest.TestCase):
+    def test_watch_predictions(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=4)
+            indices = {'a': 1, 'b': 2, 'c': 3}
+            expected = dice_metrics(gt_dir, pred_dir, None, indices)
+            watched_dir = os.path.join(tmp, 'watched')
+            os.makedirs(watched_dir)
+            shutil.copy(os.path.join(pred_dir, 'case_0.nii.gz'), watched_dir)
+
+            def write_predictions():
+                for i in range(1, 4):
+                    time.sleep(0.05)
+                    shutil.copy(os.path.join(pred_dir, f'case_{i}.nii.gz'), watched_dir)
+
+            writer = threading.Thread(target=write_predictions)
+            writer.start()
+            output_path = os.path.join(tmp, 'results.json')
+            metrics = watch_predictions(gt_dir, watched_dir, output_path, indices, poll_interval=0.02, timeout=10)
+            writer.join()
+            self.assertEqual(metrics, expected)
+            with open(output_path) as f:
+                self.assertEqual(json.load(f), expected)
+            self.assertFalse(any(x.endswith('.tmp') for x in os.listdir(tmp)))
+
+    def test_watch_mismatched_prediction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=3)
+            indices = {'a': 1, 'b': 2}
+            watched_dir = os.path.join(tmp, 'watched')
+            shutil.copytree(pred_dir, watched_dir)
+            os.remove(os.path.join(pred_dir, 'case_1.nii.gz'))
+            expected = dice_metrics(gt_dir, pred_dir, None, indices, ignore_gt_size=True)
+            create_and_write_volume(os.path.join(watched_dir, 'case_1.nii.gz'), size=(10, 10, 10))
+
+            output_path = os.path.join(tmp, 'results.json')
+            metrics = watch_predictions(gt_dir, watched_dir, output_path, indices, poll_interval=0.02, timeout=10)
+            self.assertEqual(metrics, expected)
+            with open(output_path) as f:
+                self.assertEqual(json.load(f), expected)
+
+    def test_watch_timeout(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            gt_dir, pred_dir = create_case_folders(tmp, cases=3)
+            os.remove(os.path.join(pred_dir, 'case_1.nii.gz'))
+            indices = {'a': 1, 'b': 2}
+            expected = dice_metrics(gt_dir, pred_dir, None, indices, ignore_gt_size=True)
+            self.assertEqual(watch_predictions(gt_dir, pred_dir, None, indices, poll_interval=0.02, timeout=0.1),
+                             expected)
+            self.assertRaisesRegex(AssertionError, 'Watching requires both the GT path and the prediction path to be '
+                                                   'folders', watch_predictions, gt_dir,
+                                   os.path.join(pred_dir, 'case_0.nii.gz'), None, indices)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 import SimpleITK as sitk
 
@@ -24,3 +26,14 @@ def write_volume(path, volume, spacing, origin, direction):
 def create_and_write_volume(path, high=5, size=(22, 21, 20), random_direction=False, dtype=np.uint8):
     volume, spacing, origin, direction = create_random_volume(high, size, random_direction, dtype=dtype)
     write_volume(path, volume, spacing, origin, direction)
+
+
+def create_case_folders(root, cases=3, suffix='.nii.gz', **kwargs):
+    gt_dir = os.path.join(root, 'gt')
+    pred_dir = os.path.join(root, 'pred')
+    os.makedirs(gt_dir)
+    os.makedirs(pred_dir)
+    for i in range(cases):
+        create_and_write_volume(os.path.join(gt_dir, f'case_{i}{suffix}'), **kwargs)
+        create_and_write_volume(os.path.join(pred_dir, f'case_{i}{suffix}'), **kwargs)
+    return gt_dir, pred_dir